@@ -1,5 +1,4 @@
 from django.contrib import admin
-from django.db.models import Count
 
 # Register your models here.
 from .models import User, Post, Follow, Like
@@ -15,10 +14,9 @@ class PostAdmin(admin.ModelAdmin):
         else:
             return Post.content
 
-    @admin.display
+    @admin.display(ordering="likes_count")
     def likes(self, Post):
-        likes_count = Post.post_likes.aggregate(Count("id"))
-        return likes_count['id__count']
+        return Post.likes_count
 
 admin.site.register(User)
 admin.site.register(Post, PostAdmin)
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class NetworkConfig(AppConfig):
     name = 'network'
+
+    def ready(self):
+        # Every connection reports its queries to the request middleware
+        from .timing import install_query_observer
+        connection_created.connect(install_query_observer)
+        install_query_observer()
@@ -0,0 +1,18 @@
+from django.urls import path
+
+from . import async_views
+from .urls import app_name, urlpatterns as sync_urlpatterns
+
+# JSON endpoints replaced by their async versions
+ASYNC_VIEWS = {
+    "follow": async_views.follow,
+    "edit_post": async_views.edit_post,
+    "like_post": async_views.like_post,
+    "export": async_views.export,
+}
+
+urlpatterns = [
+    path(str(pattern.pattern), ASYNC_VIEWS[pattern.name], name=pattern.name)
+    if pattern.name in ASYNC_VIEWS else pattern
+    for pattern in sync_urlpatterns
+]
@@ -0,0 +1,112 @@
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import JsonResponse
+
+from .models import User, Post, Follow, Like
+from . import metrics as network_metrics, sharding
+from .events import get_bus
+from .transfer import aiterate
+from .views import export_response
+
+
+def login_required(view):
+    """login_required for async views, reading the user without blocking"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, user, *args, **kwargs)
+    return wrapper
+
+
+@login_required
+async def follow(request, user):
+    """Update following button"""
+    if request.method == "POST":
+        data = json.loads(request.body)
+        user_to_follow = await User.objects.aget(pk=int(data['user_to_follow']))
+        # Follow someone
+        if data['follow'].strip() == "Follow":
+            follow = Follow(user_following=user, user_followed=user_to_follow)
+            follow.follow_is_valid()
+            await follow.asave()
+            message = "Following"
+        # Unfollow someone
+        else:
+            unfollow = await Follow.objects.aget(user_following=user,
+                user_followed=user_to_follow)
+            await unfollow.adelete()
+            message = "Unfollowing"
+        network_metrics.follows_changed.inc(action=message.lower())
+        await user_to_follow.arefresh_from_db(fields=["followers_count"])
+        result = {
+            "message": message,
+            "followersCount": user_to_follow.followers_count,
+        }
+        return JsonResponse(result)
+    else:
+        return JsonResponse({"message": "Method should be POST"})
+
+
+@login_required
+async def edit_post(request, user, post_id):
+    """Modify the content of a post"""
+    if request.method == "PUT":
+        shard = None
+        if sharding.shards():
+            # Reading the shard map may query the database
+            shard = await sync_to_async(sharding.shard_for_post)(post_id)
+        post = await Post.objects.using(shard).aget(pk=post_id)
+        data = json.loads(request.body)
+        post.content = data['content']
+        await post.asave(update_fields=["content"])
+        return JsonResponse({"message": "Post modified succesfully"})
+    else:
+        return JsonResponse({"message": "Method should be PUT"})
+
+
+@login_required
+async def like_post(request, user, post_id):
+    """
+    Like (PUT) or unlike (DELETE) a post, retries change nothing. POST
+    toggles the like.
+    """
+    if request.method == "PUT":
+        result, liked = await Like.objects.alike(user.id, post_id), True
+    elif request.method == "DELETE":
+        result, liked = await Like.objects.aunlike(user.id, post_id), False
+    elif request.method == "POST":
+        result = await Like.objects.atoggle(user.id, post_id)
+    else:
+        return JsonResponse({"message": "You should use request method POST"})
+    if result is None:
+        return JsonResponse({"message": "Post not found"}, status=404)
+
+    likes_count, changed = result
+    # A toggle tells whether the post ended up liked, it always changes
+    if request.method == "POST":
+        liked, changed = changed, True
+    message = "liked" if liked else "unliked"
+    if changed:
+        network_metrics.likes_toggled.inc(action=message)
+        # Async views run outside transactions, publish right away
+        get_bus().publish("like", {"id": post_id, "likesCount": likes_count})
+    return JsonResponse({
+        "message": message,
+        "likesCount": likes_count,
+        })
+
+
+@login_required
+async def export(request, user):
+    """
+    Download the posts, likes and follow lists of the user. Django would
+    read a blocking stream whole before sending it under ASGI.
+    """
+    # Locating the shards of the user may query the database
+    return await sync_to_async(export_response)(request, user,
+        stream=aiterate)
@@ -0,0 +1,134 @@
+from django.db import transaction
+from django.db.models import F
+
+from . import models, sharding
+from .models import User, Post, Follow, Like, TimelineEntry, Job
+
+# Operations accepted by apply_operations() and the target they take
+OPERATIONS = {
+    "like": "post",
+    "unlike": "post",
+    "follow": "user",
+    "unfollow": "user",
+}
+MAX_OPERATIONS = 100
+
+
+def parse_operations(operations):
+    """
+    Final state wanted for each post and user, later operations on the same
+    target win. Raises ValueError on malformed operations.
+    """
+    if not isinstance(operations, list) or len(operations) > MAX_OPERATIONS:
+        raise ValueError(f"Send a list of up to {MAX_OPERATIONS} operations")
+    likes, follows = {}, {}
+    for operation in operations:
+        try:
+            name = operation["op"]
+            target = int(operation[OPERATIONS[name]])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Invalid operation {operation}")
+        if name in ("like", "unlike"):
+            likes[target] = name == "like"
+        else:
+            follows[target] = name == "follow"
+    return likes, follows
+
+
+def apply_shard_likes(db, user, likes):
+    """Like and unlike posts of one database, returns the posts that changed"""
+    likes_manager = Like.objects.db_manager(db)
+    added = likes_manager.like_many(user.id, [post_id
+        for post_id, like in likes.items() if like])
+    removed = likes_manager.unlike_many(user.id, [post_id
+        for post_id, like in likes.items() if not like])
+    # Moved by the rows written, concurrent batches add up
+    for post_ids, step in ((added, 1), (removed, -1)):
+        if post_ids:
+            Post.objects.using(db).filter(pk__in=post_ids).update(
+                likes_count=F("likes_count") + step,
+                version=F("version") + 1)
+    return added + removed
+
+
+def apply_likes(user, likes):
+    """
+    Like and unlike posts in bulk, returns the posts that changed. On
+    sharded databases each shard commits the likes of its posts.
+    """
+    changed = []
+    for db, post_ids in sharding.group_by_shard(likes,
+            sharding.shard_for_post).items():
+        with transaction.atomic(using=db, savepoint=False):
+            changed += apply_shard_likes(db, user, {post_id: likes[post_id]
+                for post_id in post_ids})
+    return changed
+
+
+def like_states(user, post_ids):
+    """Likes count of the given posts and whether the user likes them"""
+    posts = {}
+    for db, post_ids in sharding.group_by_shard(post_ids,
+            sharding.shard_for_post).items():
+        liked = set(Like.objects.using(db).filter(user=user,
+            post__in=post_ids).values_list("post", flat=True))
+        posts.update({
+            post_id: {"likesCount": likes_count, "liked": post_id in liked}
+            for post_id, likes_count in Post.objects.using(db).filter(
+            pk__in=post_ids).values_list("id", "likes_count")
+        })
+    return posts
+
+
+def apply_follows(user, follows):
+    """Follow and unfollow users in bulk, returns the users that changed"""
+    added = Follow.objects.follow_many(user.pk, [user_id
+        for user_id, follow in follows.items() if follow])
+    removed = Follow.objects.unfollow_many(user.pk, [user_id
+        for user_id, follow in follows.items() if not follow])
+    changed = added + removed
+    if not changed:
+        return changed
+
+    # Moved by the rows written, concurrent batches add up
+    for user_ids, step in ((added, 1), (removed, -1)):
+        if user_ids:
+            User.objects.filter(pk__in=user_ids).update(
+                followers_count=F("followers_count") + step)
+    User.objects.filter(pk=user.pk).update(
+        following_count=F("following_count") + len(added) - len(removed),
+        state_version=F("state_version") + 1)
+    TimelineEntry.objects.pause_fan_out(User.objects.filter(pk__in=added))
+    TimelineEntry.objects.resume_fan_out(User.objects.filter(pk__in=removed))
+    if models.DEFER_WORK:
+        Job.objects.enqueue_many("backfill", [{"user": user.pk,
+            "followed": user_id} for user_id in added])
+        Job.objects.enqueue_many("trim", [{"user": user.pk,
+            "followed": user_id} for user_id in removed])
+        return changed
+    TimelineEntry.objects.backfill_many(Follow.objects.filter(
+        user_following=user, user_followed__in=added))
+    TimelineEntry.objects.filter(user=user, creator__in=removed).delete()
+    return changed
+
+
+def apply_operations(user, operations):
+    """
+    Apply a batch of like, unlike, follow and unfollow operations in one
+    transaction. Returns the resulting state of every target.
+    """
+    likes, follows = parse_operations(operations)
+    with transaction.atomic():
+        changed_posts = apply_likes(user, likes)
+        changed_users = apply_follows(user, follows)
+
+        posts = like_states(user, likes)
+        following = set(Follow.objects.filter(user_following=user,
+            user_followed__in=follows).values_list("user_followed", flat=True))
+        users = {
+            user_id: {"followersCount": followers_count,
+                "following": user_id in following}
+            for user_id, followers_count in User.objects.filter(
+            pk__in=follows).values_list("id", "followers_count")
+        }
+    return posts, users, changed_posts, changed_users
@@ -0,0 +1,241 @@
+"""
+View benchmarks, kept out of the test*.py discovery of ``manage.py test``.
+Run them with ``python manage.py test network.benchmarks``.
+"""
+import asyncio
+import json
+import os
+import time
+from io import StringIO
+from statistics import quantiles
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import User, Post, Follow, TimelineEntry
+
+
+# Multiply the seeded dataset, e.g. NETWORK_BENCH_SCALE=10
+SCALE = float(os.environ.get("NETWORK_BENCH_SCALE", 1))
+# Requests timed per endpoint
+ROUNDS = int(os.environ.get("NETWORK_BENCH_ROUNDS", 20))
+# Requests in flight while measuring throughput
+CONCURRENCY = int(os.environ.get("NETWORK_BENCH_CONCURRENCY", 10))
+# JSON file receiving the timings, e.g. NETWORK_BENCH_RESULTS=/tmp/perf.json
+RESULTS_FILE = os.environ.get("NETWORK_BENCH_RESULTS")
+
+
+def percentiles(timings):
+    """p50, p95 and p99 of a list of durations, in milliseconds"""
+    cuts = quantiles(timings, n=100, method="inclusive")
+    return {
+        "p50": round(cuts[49] * 1000, 3),
+        "p95": round(cuts[94] * 1000, 3),
+        "p99": round(cuts[98] * 1000, 3),
+    }
+
+
+class NetworkPerformanceTestCase(TestCase):
+    """
+    Run every view against a seeded dataset with a query budget per request.
+    Timings are written to RESULTS_FILE, when set, to compare them between
+    commits.
+    """
+    # Maximum queries per request, savepoints included
+    budgets = {
+        "index": 4,
+        "index_anonymous": 1,
+        "profile": 5,
+        "following": 6,
+        "api_posts": 4,
+        "like_post": 10,
+        "like_post_put": 6,
+        "batch": 38,
+        "follow": 13,
+        "edit_post": 7,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command("seed_network", "--until=2024-01-01",
+            users=int(200 * SCALE), posts=int(2000 * SCALE),
+            follows=int(3000 * SCALE), likes=int(10000 * SCALE), seed=1,
+            stdout=StringIO())
+        # The busiest reader and the most followed account
+        cls.viewer = User.objects.order_by("-following_count").first()
+        cls.star = User.objects.exclude(pk=cls.viewer.pk).order_by(
+            "-followers_count").first()
+        cls.post = Post.objects.filter(creator=cls.viewer).first() or \
+            Post.objects.create(content="bench", creator=cls.viewer)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = {}
+        cls.throughput = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if RESULTS_FILE:
+            with open(RESULTS_FILE, "w") as results:
+                json.dump({"scale": SCALE, "rounds": ROUNDS,
+                    "views": cls.results, "throughput": cls.throughput},
+                    results, indent=2, sort_keys=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.viewer)
+
+    def measure(self, name, request):
+        """Time ROUNDS calls of request, failing when one breaks the budget"""
+        timings = []
+        most_queries = 0
+        for i in range(ROUNDS):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = request(i)
+                timings.append(time.perf_counter() - started)
+            self.assertEqual(response.status_code, 200)
+            most_queries = max(most_queries, len(queries))
+            self.assertLessEqual(len(queries), self.budgets[name],
+                "\n".join(query["sql"] for query in queries.captured_queries))
+        self.results[name] = {"queries": most_queries, **percentiles(timings)}
+
+    def test_index(self):
+        next_page = {}
+
+        def request(i):
+            # Walk the feed deeper on every round
+            response = self.client.get(reverse("network:index"), next_page)
+            next_page["cursor"] = response.context["posts"].next_cursor
+            return response
+        self.measure("index", request)
+
+    def test_index_anonymous(self):
+        self.client.logout()
+        self.measure("index_anonymous",
+            lambda i: self.client.get(reverse("network:index")))
+
+    def test_profile(self):
+        self.measure("profile", lambda i: self.client.get(
+            reverse("network:profile", args=[self.star.id])))
+
+    def test_following(self):
+        self.measure("following",
+            lambda i: self.client.get(reverse("network:following")))
+
+    def test_api_posts(self):
+        next_page = {"feed": "all"}
+
+        def request(i):
+            # Scroll deeper on every round
+            response = self.client.get(reverse("network:api_posts"),
+                next_page)
+            next_page["cursor"] = response.json()["nextCursor"]
+            return response
+        self.measure("api_posts", request)
+
+    def test_like_post(self):
+        self.measure("like_post", lambda i: self.client.post(
+            reverse("network:like_post", args=[self.post.id])))
+
+    def test_like_post_put(self):
+        self.measure("like_post_put", lambda i: self.client.put(
+            reverse("network:like_post", args=[self.post.id])))
+
+    def test_batch(self):
+        posts = list(Post.objects.exclude(creator=self.viewer).values_list(
+            "id", flat=True)[:10])
+        users = list(User.objects.exclude(pk=self.viewer.pk).values_list(
+            "id", flat=True)[:5])
+        # Ten likes and five follows per request, undone every other round
+        self.measure("batch", lambda i: self.client.post(
+            reverse("network:batch"), {"operations": [
+                {"op": "unlike" if i % 2 else "like", "post": post_id}
+                for post_id in posts] + [
+                {"op": "unfollow" if i % 2 else "follow", "user": user_id}
+                for user_id in users]}, content_type="application/json"))
+
+    def test_follow(self):
+        Follow.objects.filter(user_following=self.viewer,
+            user_followed=self.star).delete()
+        self.measure("follow", lambda i: self.client.post(
+            reverse("network:follow"), {
+                "follow": "Unfollow" if i % 2 else "Follow",
+                "user_to_follow": self.star.id,
+            }, content_type="application/json"))
+
+    def test_edit_post(self):
+        self.measure("edit_post", lambda i: self.client.put(
+            reverse("network:edit_post", args=[self.post.id]),
+            {"content": f"edit {i}"}, content_type="application/json"))
+
+    async def run_concurrently(self, urlconf, requests):
+        """Requests per second of coroutines run CONCURRENCY at a time"""
+        client = AsyncClient()
+        await client.aforce_login(self.viewer)
+        slots = asyncio.Semaphore(CONCURRENCY)
+
+        async def run(request):
+            async with slots:
+                return await request(client)
+
+        with self.settings(ROOT_URLCONF=urlconf):
+            started = time.perf_counter()
+            responses = await asyncio.gather(*map(run, requests))
+            elapsed = time.perf_counter() - started
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+        return round(len(requests) / elapsed, 1)
+
+    async def test_async_throughput(self):
+        """Sync views against their async versions, as served by ASGI"""
+        count = ROUNDS * 5
+        posts = [post_id async for post_id in Post.objects.exclude(
+            creator=self.viewer).values_list("id", flat=True)[:count]]
+        followed = Follow.objects.filter(user_following=self.viewer).values(
+            "user_followed")
+        users = [user_id async for user_id in User.objects.exclude(
+            pk=self.viewer.pk).exclude(pk__in=followed).values_list("id",
+            flat=True)[:count]]
+
+        def like(post_id):
+            return lambda client: client.post(reverse("network:like_post",
+                args=[post_id]))
+
+        def follow(user_id, action):
+            return lambda client: client.post(reverse("network:follow"), {
+                "follow": action, "user_to_follow": user_id},
+                content_type="application/json")
+
+        def edit(post_id):
+            return lambda client: client.put(reverse("network:edit_post",
+                args=[post_id]), {"content": "bench"},
+                content_type="application/json")
+
+        # The async run undoes the likes and follows of the sync run
+        for name, sync_requests, async_requests in [
+            ("like_post", [like(i) for i in posts], [like(i) for i in posts]),
+            ("follow", [follow(i, "Follow") for i in users],
+                [follow(i, "Unfollow") for i in users]),
+            ("edit_post", [edit(i) for i in posts], [edit(i) for i in posts]),
+        ]:
+            self.throughput[name] = {
+                "sync": await self.run_concurrently("project4.urls",
+                    sync_requests),
+                "async": await self.run_concurrently("project4.async_urls",
+                    async_requests),
+            }
+
+    def test_explain_feeds(self):
+        # Include followed accounts read on demand in the following feed
+        limit = self.star.followers_count
+        with patch("network.models.FANOUT_FOLLOWER_LIMIT", limit):
+            TimelineEntry.objects.pause_fan_out(User.objects.all())
+            call_command("explain_feeds", user=self.viewer.id,
+                stdout=StringIO())
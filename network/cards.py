@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.templatetags.static import static
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+
+# Change it along with post_card.html so cards cached before are ignored
+CARD_TEMPLATE_VERSION = 1
+# Viewer dependent parts left out of the cached markup
+EDIT_SLOT = "<!--edit-->"
+LIKE_SLOT = "<!--like-->"
+
+
+def card_cache():
+    """Cache backend of the cards, configured by NETWORK_CARD_CACHE"""
+    return caches[getattr(settings, "NETWORK_CARD_CACHE", "default")]
+
+
+def card_key(post):
+    """
+    Cache key of a post card. The version changes with every edit or like,
+    the creation time keeps reused ids apart.
+    """
+    return (f"post-card:{CARD_TEMPLATE_VERSION}:{post.id}:{post.version}:"
+        f"{post.created_at.timestamp()}")
+
+
+def get_cards(posts):
+    """Shared markup of each post, rendering only the ones not cached"""
+    cache = card_cache()
+    keys = {card_key(post): post for post in posts}
+    cards = cache.get_many(keys)
+    missing = {
+        key: render_to_string("network/post_card.html", {"post": post})
+        for key, post in keys.items() if key not in cards
+    }
+    if missing:
+        cache.set_many(missing)
+        cards.update(missing)
+    return [(post, cards[key]) for key, post in keys.items()]
+
+
+def edit_link(post, viewer):
+    """Edit link shown to the creator of the post"""
+    if viewer.is_authenticated and viewer.id == post.creator_id:
+        return format_html(
+            '<div class="col text-right">'
+            '<a class="editPost" id="edit-{}" href="#">Edit</a></div>',
+            post.id)
+    return ""
+
+
+def like_button(post, viewer):
+    """Like or unlike icon for signed in users"""
+    if not viewer.is_authenticated:
+        return ""
+    if post.liked:
+        icon, action = "network/dislike.svg", "Unlike"
+    else:
+        icon, action = "network/like.svg", "Like"
+    return format_html(
+        '<img class="like" src="{}" alt="{}">'
+        '<span class="ml-auto position-relative">{}</span>',
+        static(icon), action, action)
+
+
+def render_cards(posts, viewer):
+    """Cards of a page of posts with the viewer's edit and like controls"""
+    html = []
+    for post, card in get_cards(posts):
+        html.append(card.replace(EDIT_SLOT, edit_link(post, viewer)).replace(
+            LIKE_SLOT, like_button(post, viewer)))
+    return mark_safe("".join(html))
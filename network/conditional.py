@@ -0,0 +1,51 @@
+import hashlib
+
+from django.conf import settings
+from django.shortcuts import render
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+    patch_vary_headers)
+from django.utils.http import quote_etag
+
+
+def page_etag(request, posts, *extra):
+    """
+    Validator of a page of posts as the current user sees it. Post versions
+    follow every edit and like, the user's state version every follow, and
+    extra takes anything else the page shows.
+    """
+    user = request.user
+    if hasattr(posts, "paginator"):
+        position = (posts.number, posts.paginator.num_pages)
+    else:
+        position = (posts.next_cursor, posts.previous_cursor)
+    state = (
+        user.id,
+        getattr(user, "state_version", None),
+        [(post.id, post.version) for post in posts],
+        position,
+        extra,
+    )
+    return hashlib.md5(repr(state).encode(), usedforsecurity=False).hexdigest()
+
+
+def render_page(request, template_name, context, etag):
+    """
+    Render a page unless the client already has it, then answer
+    304 Not Modified without rendering the template.
+
+    Anonymous pages may be kept by shared caches for
+    NETWORK_ANONYMOUS_MAX_AGE seconds, the rest must be revalidated.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return render(request, template_name, context)
+    response = get_conditional_response(request, etag=quote_etag(etag))
+    if response is None:
+        response = render(request, template_name, context)
+    response["ETag"] = quote_etag(etag)
+    if request.user.is_authenticated:
+        patch_cache_control(response, private=True, no_cache=True)
+    else:
+        patch_cache_control(response, public=True, max_age=getattr(settings,
+            "NETWORK_ANONYMOUS_MAX_AGE", 30))
+    patch_vary_headers(response, ["Cookie"])
+    return response
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+class Subscription:
+    """Events received by one client, read with async for"""
+    def __init__(self, bus, max_pending):
+        self.bus = bus
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(max_pending)
+
+    def put(self, event):
+        # Slow clients lose events instead of growing the queue
+        if not self.queue.full():
+            self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """Next (name, data) event, None if timeout seconds go by"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class LocalBus:
+    """
+    Broadcast events to the clients connected to this process.
+
+    Any object with the same publish(), subscribe() and unsubscribe()
+    methods can replace it through the NETWORK_EVENT_BUS setting, e.g. one
+    relaying events between processes.
+    """
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """Start receiving events, called from the event loop"""
+        subscription = Subscription(self, self.max_pending)
+        with self._lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, name, data):
+        """Send an event to every client, safe to call from any thread"""
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put,
+                    (name, data))
+            except RuntimeError:
+                # Its event loop is closed
+                self.unsubscribe(subscription)
+
+
+_bus = None
+
+
+def get_bus():
+    """Event bus set by NETWORK_EVENT_BUS, LocalBus by default"""
+    global _bus
+    if _bus is None:
+        path = getattr(settings, "NETWORK_EVENT_BUS",
+            "network.events.LocalBus")
+        _bus = import_string(path)()
+    return _bus
+
+
+def served_by_asgi(request):
+    """
+    Whether streams reach the client as they are made, Django reads them
+    to the end first under WSGI
+    """
+    return isinstance(request, ASGIRequest)
+
+
+def publish_on_commit(name, data):
+    """Publish an event once the current transaction is committed"""
+    transaction.on_commit(lambda: get_bus().publish(name, data))
+
+
+def format_event(name, data):
+    """Server-Sent Events message"""
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def event_stream(post_ids, creators):
+    """
+    Stream the like counts of post_ids and the new posts of creators, every
+    creator when it is None. The stream ends after NETWORK_EVENTS_DURATION
+    seconds and the browser reconnects.
+    """
+    heartbeat = getattr(settings, "NETWORK_EVENTS_HEARTBEAT", 15)
+    duration = getattr(settings, "NETWORK_EVENTS_DURATION", 300)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    subscription = get_bus().subscribe()
+    try:
+        yield "retry: 5000\n\n"
+        while (remaining := deadline - loop.time()) > 0:
+            event = await subscription.get(min(heartbeat, remaining))
+            if event is None:
+                # Keep proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            name, data = event
+            if name == "like" and data["id"] in post_ids:
+                yield format_event(name, data)
+            elif name == "post" and (creators is None or
+                    data["creator"] in creators):
+                yield format_event(name, data)
+    finally:
+        subscription.close()
@@ -0,0 +1,101 @@
+from django.db.models import Prefetch, prefetch_related_objects
+
+from . import sharding
+from .models import User, Like, Post, TimelineEntry
+from .pagination import paginate_posts
+
+
+# Columns rendered by a post card
+CARD_FIELDS = ("id", "content", "created_at", "likes_count", "version",
+    "creator__id", "creator__username")
+
+
+def card_posts(posts):
+    """
+    Load only what a post card renders, with the creator in the same query
+    and the stored likes counter. Shards have no users to join, get_feed()
+    reads the creators of the page afterwards.
+    """
+    if sharding.shards():
+        return posts.only(*CARD_FIELDS[:-2], "creator")
+    return posts.select_related("creator").only(*CARD_FIELDS)
+
+
+def all_posts():
+    """Posts of the index, one source per shard on sharded databases"""
+    if sharding.shards():
+        return [(Post.objects.using(shard), ("created_at", "id"))
+            for shard in sharding.shards()]
+    return Post.objects.all()
+
+
+def user_posts(user_id):
+    """Posts of a profile, read from the shard of the user"""
+    return Post.objects.using(sharding.shard_for_user(user_id)).filter(
+        creator=user_id)
+
+
+def get_liked_posts(viewer, posts):
+    """Ids of the given posts liked by the viewer, None for anonymous users"""
+    if not viewer.is_authenticated:
+        return None
+    liked = set()
+    # Likes are read where their posts came from
+    for db, post_ids in sharding.group_by_shard([post.id for post in posts],
+            {post.id: post._state.db for post in posts}.get).items():
+        liked.update(Like.objects.using(db).filter(user=viewer,
+            post__in=post_ids).values_list("post", flat=True))
+    return liked
+
+
+def get_feed(request, posts):
+    """
+    Page of posts ready to render, posts can be a queryset or the sources
+    of a merged feed. Any page size takes the same number of queries.
+
+    Each post gets a liked flag, and the page keeps the set of liked ids
+    in liked_posts.
+    """
+    if isinstance(posts, list):
+        posts = [(card_posts(queryset), keys) for queryset, keys in posts]
+    else:
+        posts = card_posts(posts)
+    page = paginate_posts(request, posts)
+    if sharding.shards():
+        prefetch_related_objects(list(page), Prefetch("creator",
+            User.objects.only("id", "username")))
+
+    page.liked_posts = get_liked_posts(request.user, page)
+    for post in page:
+        post.liked = bool(page.liked_posts) and post.id in page.liked_posts
+    return page
+
+
+def feed_sources(feed, viewer):
+    """
+    Sources of a named feed for the JSON API: "all", "following" or
+    "user:<id>". Raises ValueError for unknown names.
+    """
+    if feed == "all":
+        posts = all_posts()
+    elif feed == "following":
+        return TimelineEntry.objects.feed_sources(viewer)
+    elif feed.startswith("user:"):
+        posts = user_posts(int(feed[len("user:"):]))
+    else:
+        raise ValueError(f"Unknown feed {feed}")
+    return posts if isinstance(posts, list) else [
+        (posts, ("created_at", "id"))]
+
+
+def serialize_post(post, viewer):
+    """Compact JSON of a post card, liked is None for anonymous users"""
+    return {
+        "id": post.id,
+        "creator": {"id": post.creator.id, "username": post.creator.username},
+        "content": post.content,
+        "createdAt": post.created_at.isoformat(),
+        "likesCount": post.likes_count,
+        "liked": post.liked if viewer.is_authenticated else None,
+        "editable": viewer.id == post.creator_id,
+    }
@@ -0,0 +1,131 @@
+import logging
+import traceback
+import uuid
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Post, Follow, TimelineEntry, Job
+
+logger = logging.getLogger("network.jobs")
+
+# Seconds before the first retry, doubled on every attempt
+RETRY_DELAY = 10
+
+# Handler and attempts allowed for every job name
+HANDLERS = {}
+
+
+def handler(name, max_attempts=5):
+    """
+    Register a function running the payloads of a batch of name jobs. It
+    must be safe to run again, a failed batch is retried job by job.
+    """
+    def register(function):
+        HANDLERS[name] = (function, max_attempts)
+        return function
+    return register
+
+
+def claim(batch_size, lease, names=None):
+    """
+    Lock up to batch_size due jobs of the same name for this worker, oldest
+    first. Another worker takes them over once the lease expires.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(Q(locked_until__isnull=True) |
+        Q(locked_until__lt=now), status=Job.PENDING, run_at__lte=now)
+    if names:
+        due = due.filter(name__in=names)
+    oldest = due.order_by("run_at", "id").values_list("name", flat=True
+        ).first()
+    if oldest is None:
+        return []
+    ids = list(due.filter(name=oldest).order_by("run_at", "id").values_list(
+        "id", flat=True)[:batch_size])
+    # Only the jobs nobody claimed meanwhile get the token
+    token = uuid.uuid4().hex
+    due.filter(id__in=ids).update(locked_by=token,
+        locked_until=now + timedelta(seconds=lease),
+        attempts=F("attempts") + 1)
+    return list(Job.objects.filter(locked_by=token).order_by("id"))
+
+
+def fail(job, error):
+    """Schedule a retry, or give up after the attempts of its handler"""
+    max_attempts = HANDLERS[job.name][1] if job.name in HANDLERS else 1
+    logger.warning("Job %s failed (attempt %s of %s): %s", job.id,
+        job.attempts, max_attempts, error)
+    changes = {"locked_by": "", "locked_until": None,
+        "last_error": "".join(traceback.format_exception(error))}
+    if job.attempts >= max_attempts:
+        changes.update(status=Job.FAILED, finished_at=timezone.now())
+    else:
+        changes["run_at"] = timezone.now() + timedelta(
+            seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+    Job.objects.filter(pk=job.pk).update(**changes)
+
+
+def execute(jobs):
+    """
+    Run claimed jobs of one name with a single handler call, or one by one
+    when the batch fails. Returns how many succeeded.
+    """
+    try:
+        function = HANDLERS[jobs[0].name][0]
+        with transaction.atomic():
+            function([job.payload for job in jobs])
+            Job.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                status=Job.DONE, finished_at=timezone.now(), locked_by="",
+                locked_until=None)
+    except Exception as error:
+        if len(jobs) == 1:
+            fail(jobs[0], error)
+            return 0
+        return sum(execute([job]) for job in jobs)
+    return len(jobs)
+
+
+def purge(keep):
+    """Delete the jobs done before keep ago, freeing their keys"""
+    return Job.objects.filter(status=Job.DONE,
+        finished_at__lt=timezone.now() - keep).delete()[0]
+
+
+@handler("fan_out")
+def fan_out(payloads):
+    """Deliver new posts to the timelines of their creator's followers"""
+    posts = Post.objects.filter(pk__in=[payload["post"]
+        for payload in payloads]).only("id", "creator", "created_at")
+    for post in posts:
+        TimelineEntry.objects.fan_out(post)
+
+
+@handler("backfill")
+def backfill(payloads):
+    """Copy the latest posts of followed users into the new timelines"""
+    TimelineEntry.objects.backfill_many(Follow.objects.filter(reduce(or_, (
+        Q(user_following=payload["user"], user_followed=payload["followed"])
+        for payload in payloads))))
+
+
+@handler("restore_fan_out")
+def restore_fan_out(payloads):
+    """Backfill the followers of users who fell below the fan-out limit"""
+    TimelineEntry.objects.backfill_many(Follow.objects.filter(
+        user_followed__in=[payload["followed"] for payload in payloads]))
+
+
+@handler("trim")
+def trim(payloads):
+    """Drop the posts of unfollowed users unless they were followed again"""
+    for payload in payloads:
+        if not Follow.objects.filter(user_following=payload["user"],
+                user_followed=payload["followed"]).exists():
+            TimelineEntry.objects.filter(user=payload["user"],
+                creator=payload["followed"]).delete()
+
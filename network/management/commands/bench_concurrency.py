@@ -0,0 +1,100 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import (DatabaseError, close_old_connections, connection,
+    connections)
+
+from network.feeds import card_posts
+from network.models import User, Post, Like
+from network.pagination import KeysetPaginator
+
+
+class Command(BaseCommand):
+    help = ("Measure read and write throughput with concurrent threads on "
+        "the seeded database, e.g. with and without "
+        "NETWORK_SQLITE_PRODUCTION=1, or on PostgreSQL with different "
+        "NETWORK_DB_CONN_MAX_AGE values")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument("--seconds", type=float, default=5)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def read(self, rng):
+        """Load a feed page, as the index or a profile does"""
+        if rng.random() < 0.5:
+            posts = Post.objects.all()
+        else:
+            posts = Post.objects.filter(creator=rng.choice(self.user_ids))
+        list(KeysetPaginator(card_posts(posts)).get_page(None))
+
+    def write(self, rng):
+        """Like or unlike a post"""
+        Like.objects.toggle(rng.choice(self.user_ids),
+            rng.choice(self.post_ids))
+
+    def worker(self, operation, seed, results):
+        rng = random.Random(seed)
+        done = errors = 0
+        try:
+            while time.perf_counter() < self.deadline:
+                try:
+                    operation(rng)
+                    done += 1
+                except DatabaseError:
+                    # e.g. "database is locked"
+                    errors += 1
+                finally:
+                    # Each operation stands for a request, which closes its
+                    # connection when it finishes unless CONN_MAX_AGE keeps it
+                    close_old_connections()
+        finally:
+            connections.close_all()
+        results.append((done, errors))
+
+    def run(self, operation, threads, seed):
+        results = []
+        workers = [
+            threading.Thread(target=self.worker, args=(operation, seed + n,
+                results))
+            for n in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        return workers, results
+
+    def handle(self, *args, **options):
+        self.user_ids = list(User.objects.values_list("id", flat=True))
+        self.post_ids = list(Post.objects.values_list("id", flat=True))
+        if not self.post_ids:
+            raise CommandError("Seed the database first, see seed_network")
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                journal = cursor.fetchone()[0]
+            self.stdout.write(f"SQLite journal_mode={journal}, "
+                f"transactions BEGIN "
+                f"{getattr(connection, 'transaction_mode', None) or ''}")
+        else:
+            self.stdout.write(f"{connection.display_name}, CONN_MAX_AGE="
+                f"{connection.settings_dict['CONN_MAX_AGE']}")
+        connection.close()
+
+        seconds = options["seconds"]
+        self.deadline = time.perf_counter() + seconds
+        readers, reads = self.run(self.read, options["readers"],
+            options["seed"])
+        writers, writes = self.run(self.write, options["writers"],
+            options["seed"] + options["readers"])
+        for worker in readers + writers:
+            worker.join()
+
+        for label, results, threads in (("Reads", reads, options["readers"]),
+                ("Writes", writes, options["writers"])):
+            done = sum(result[0] for result in results)
+            errors = sum(result[1] for result in results)
+            self.stdout.write(f"{label}: {done / seconds:,.0f}/s with "
+                f"{threads} threads, {errors} errors")
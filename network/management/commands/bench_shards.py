@@ -0,0 +1,154 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from itertools import islice
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from network import sharding
+from network.feeds import all_posts, get_feed, user_posts
+from network.models import User, Post, Like, ShardBucket
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ("Compare one shard with several, as local SQLite files holding "
+        "the posts and likes of the seeded database: profile and index "
+        "page latency and concurrent like throughput")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", type=int, default=4)
+        parser.add_argument("--posts", type=int, default=20000,
+            help="Posts copied from the seeded database")
+        parser.add_argument("--reads", type=int, default=200,
+            help="Pages read from each feed")
+        parser.add_argument("--writers", type=int, default=4)
+        parser.add_argument("--seconds", type=float, default=3)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def bulk(self, model, rows):
+        """Insert rows on the shard of each, in batches"""
+        for shard, shard_rows in rows.items():
+            shard_rows = iter(shard_rows)
+            while batch := list(islice(shard_rows, self.batch_size)):
+                with transaction.atomic(using=shard):
+                    model.objects.using(shard).bulk_create(batch,
+                        ignore_conflicts=True)
+
+    def load(self):
+        """Copy the posts and likes, with ids drawn for the shards"""
+        posts = Post.objects.using(DEFAULT_DB_ALIAS).order_by("-id")[
+            :self.options["posts"]]
+        post_ids, rows = {}, {}
+        for post in posts.iterator():
+            old_id = post.id
+            post.id = sharding.new_post_id(post.creator_id, post.created_at)
+            post_ids[old_id] = post.id
+            rows.setdefault(sharding.shard_for_user(post.creator_id),
+                []).append(post)
+        self.bulk(Post, rows)
+
+        rows = {}
+        likes = Like.objects.using(DEFAULT_DB_ALIAS).filter(
+            post__gte=min(post_ids, default=0)).values_list("user", "post")
+        for user_id, old_id in likes.iterator():
+            if old_id in post_ids:
+                post_id = post_ids[old_id]
+                rows.setdefault(sharding.shard_for_post(post_id), []).append(
+                    Like(user_id=user_id, post_id=post_id))
+        self.bulk(Like, rows)
+        return list(post_ids.values())
+
+    def time_pages(self, request, feed):
+        """Milliseconds taken by each page of a feed"""
+        samples = []
+        for n in range(self.options["reads"]):
+            started = time.perf_counter()
+            list(get_feed(request, feed()))
+            samples.append((time.perf_counter() - started) * 1000)
+        return samples
+
+    def like(self, post_ids, seed, results):
+        rng = random.Random(seed)
+        done = errors = 0
+        try:
+            while time.perf_counter() < self.deadline:
+                try:
+                    Like.objects.toggle(rng.choice(self.user_ids),
+                        rng.choice(post_ids))
+                    done += 1
+                except DatabaseError:
+                    errors += 1
+        finally:
+            connections.close_all()
+        results.append((done, errors))
+
+    def run(self, shards):
+        post_ids = self.load()
+        rng = random.Random(self.options["seed"])
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(pk=rng.choice(self.user_ids))
+
+        creators = [rng.choice(self.user_ids)
+            for n in range(self.options["reads"])]
+        profile = self.time_pages(request, lambda: user_posts(creators.pop()))
+        index = self.time_pages(request, all_posts)
+
+        results = []
+        self.deadline = time.perf_counter() + self.options["seconds"]
+        writers = [
+            threading.Thread(target=self.like, args=(post_ids,
+                self.options["seed"] + n, results))
+            for n in range(self.options["writers"])
+        ]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        done = sum(result[0] for result in results)
+        errors = sum(result[1] for result in results)
+
+        self.stdout.write(f"{len(shards)} shard(s): profile p50 "
+            f"{percentile(profile, 0.5):.1f}ms p95 "
+            f"{percentile(profile, 0.95):.1f}ms, index p50 "
+            f"{percentile(index, 0.5):.1f}ms p95 "
+            f"{percentile(index, 0.95):.1f}ms, likes "
+            f"{done / self.options['seconds']:,.0f}/s with "
+            f"{self.options['writers']} threads, {errors} errors")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.batch_size = options["batch_size"]
+        self.user_ids = list(User.objects.values_list("id", flat=True))
+        if not Post.objects.using(DEFAULT_DB_ALIAS).exists():
+            raise CommandError("Seed the database first, see seed_network")
+
+        for count in sorted({1, options["shards"]}):
+            shards = [f"bench_shard{n}" for n in range(count)]
+            with tempfile.TemporaryDirectory() as directory:
+                for shard in shards:
+                    sharding.add_database(shard, os.path.join(directory,
+                        f"{shard}.sqlite3"))
+                try:
+                    with override_settings(NETWORK_SHARDS=shards):
+                        for shard in shards:
+                            call_command("migrate", database=shard,
+                                verbosity=0)
+                        sharding.shard_map.clear()
+                        self.run(shards)
+                finally:
+                    sharding.shard_map.clear()
+                    ShardBucket.objects.filter(shard__in=shards).delete()
+                    for shard in shards:
+                        sharding.remove_database(shard)
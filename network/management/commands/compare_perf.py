@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Compare two performance results files written by the test suite"
+
+    def add_arguments(self, parser):
+        parser.add_argument("baseline", help="Results of the older commit")
+        parser.add_argument("current", help="Results of the newer commit")
+        parser.add_argument("--threshold", type=float, default=20,
+            help="Percent of p95 slowdown reported as a regression")
+
+    def handle(self, *args, **options):
+        with open(options["baseline"]) as baseline:
+            old = json.load(baseline)
+        with open(options["current"]) as current:
+            new = json.load(current)
+        self.show_throughput(new.get("throughput", {}))
+        old, new = old["views"], new["views"]
+
+        regressions = []
+        for view in sorted(new):
+            if view not in old:
+                self.stdout.write(f"{view}: new")
+                continue
+            before, after = old[view], new[view]
+            change = (after["p95"] - before["p95"]) / before["p95"] * 100
+            self.stdout.write(f"{view}: p95 {before['p95']}ms -> "
+                f"{after['p95']}ms ({change:+.1f}%), queries "
+                f"{before['queries']} -> {after['queries']}")
+            if change > options["threshold"] or \
+                    after["queries"] > before["queries"]:
+                regressions.append(view)
+
+        if regressions:
+            raise CommandError(f"Regressions in: {', '.join(regressions)}")
+
+    def show_throughput(self, throughput):
+        """Requests per second of the sync and async views"""
+        for view, modes in sorted(throughput.items()):
+            self.stdout.write(f"{view}: {modes['sync']} req/s sync, "
+                f"{modes['async']} req/s async")
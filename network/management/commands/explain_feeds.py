@@ -0,0 +1,95 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from network.feeds import card_posts
+from network.models import User, Post, Like, TimelineEntry
+from network.pagination import (KeysetPaginator, LAST, NEXT, PREVIOUS,
+    POSTS_PER_PAGE)
+
+
+def plan_problems(plan, seek):
+    """
+    Full scans and sorts in a query plan. Pages after a cursor must seek
+    the index instead of scanning it from the start.
+    """
+    for line in plan.splitlines():
+        if connection.vendor == "sqlite":
+            # "<id> <parent> <unused> <detail>"
+            detail = line.split(maxsplit=3)[-1]
+            if "TEMP B-TREE" in detail:
+                yield detail
+            elif detail.startswith("SCAN") and (seek or "INDEX" not in
+                    detail):
+                yield detail
+        elif connection.vendor == "postgresql":
+            node = line.strip()
+            if "Seq Scan" in node or re.match(r"(->\s*)?Sort\b", node):
+                yield node
+
+
+class Command(BaseCommand):
+    help = ("EXPLAIN the queries of every feed, failing on full scans and "
+        "sorts")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", type=int,
+            help="Viewer of the feeds, the user following most by default")
+
+    def feed_queries(self, viewer):
+        """Name, query and whether it should seek, for each feed page"""
+        creator = Post.objects.order_by("-created_at").values_list(
+            "creator", flat=True).first()
+        middle = Post.objects.order_by("-created_at", "-id")[
+            Post.objects.count() // 2]
+        cursors = {
+            "first": None,
+            "next": (NEXT, middle.created_at, middle.id),
+            "previous": (PREVIOUS, middle.created_at, middle.id),
+            "last": (LAST, None, None),
+        }
+        feeds = {
+            "index": [Post.objects.all()],
+            "profile": [Post.objects.filter(creator=creator)],
+            "following": TimelineEntry.objects.feed_sources(viewer),
+        }
+        for feed, sources in feeds.items():
+            sources = [(card_posts(source[0]), source[1])
+                if isinstance(source, tuple) else card_posts(source)
+                for source in sources]
+            paginator = KeysetPaginator(*sources)
+            for page, cursor in cursors.items():
+                queries = paginator.queries(cursor, POSTS_PER_PAGE + 1)
+                for number, (queryset, keys) in enumerate(queries, 1):
+                    name = f"{feed} {page}"
+                    if len(sources) > 1:
+                        name += f" (source {number})"
+                    yield name, queryset, page in ("next", "previous")
+
+        page_ids = list(Post.objects.order_by("-created_at", "-id")
+            .values_list("id", flat=True)[:POSTS_PER_PAGE])
+        yield "liked posts", Like.objects.filter(user=viewer,
+            post__in=page_ids).values_list("post", flat=True), True
+
+    def handle(self, *args, **options):
+        if options["user"]:
+            viewer = User.objects.get(pk=options["user"])
+        else:
+            viewer = User.objects.order_by("-following_count").first()
+        if viewer is None or not Post.objects.exists():
+            raise CommandError("Seed the database first, see seed_network")
+
+        failures = []
+        for name, queryset, seek in self.feed_queries(viewer):
+            plan = queryset.explain()
+            problems = list(plan_problems(plan, seek))
+            if problems:
+                failures.append(name)
+            self.stdout.write(f"{name}: {'; '.join(problems) or 'ok'}")
+            if options["verbosity"] > 1:
+                self.stdout.write(plan)
+
+        if failures:
+            raise CommandError(f"Full scans or sorts in: "
+                f"{', '.join(failures)}")
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from network.transfer import (FORMATS, TABLES, databases, guess_format,
+    write_rows)
+
+
+class Command(BaseCommand):
+    help = ("Stream posts, likes or follows out as JSON lines or CSV, in "
+        "constant memory however large the table")
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", choices=TABLES)
+        parser.add_argument("--output",
+            help="File to write, the standard output by default")
+        parser.add_argument("--format", choices=FORMATS,
+            help="Defaults to the extension of --output, else jsonl")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+            help="Rows fetched from the database at a time")
+
+    def rows(self, model, columns, chunk_size):
+        """Rows of every database in id order, fetched in chunks"""
+        for db in databases(model):
+            rows = model.objects.using(db).order_by("pk").values_list(
+                *columns)
+            for row in rows.iterator(chunk_size=chunk_size):
+                self.count += 1
+                yield row
+
+    def handle(self, *args, **options):
+        model, columns = TABLES[options["table"]]
+        format = guess_format(options["output"], options["format"])
+        rows = self.rows(model, columns, options["chunk_size"])
+        self.count = 0
+        started = time.perf_counter()
+        if options["output"]:
+            with open(options["output"], "w", newline="",
+                    encoding="utf-8") as output:
+                write_rows(output, format, columns, rows)
+        else:
+            write_rows(self.stdout, format, columns, rows)
+
+        # Reported apart from the rows written to the standard output
+        elapsed = time.perf_counter() - started
+        rate = self.count / elapsed if elapsed else self.count
+        self.stderr.write(f"Exported {self.count} {options['table']} in "
+            f"{elapsed:.1f}s ({rate:,.0f} rows/s)",
+            style_func=self.style.SUCCESS)
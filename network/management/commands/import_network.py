@@ -0,0 +1,163 @@
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import F
+
+from network import sharding
+from network.models import (User, Post, Follow, Like, TimelineEntry,
+    count_of)
+from network.transfer import (FORMATS, TABLES, databases, guess_format,
+    read_rows)
+
+
+class Command(BaseCommand):
+    help = ("Load posts, likes or follows from JSON lines or CSV written by "
+        "export_network, in batches")
+
+    def add_arguments(self, parser):
+        parser.add_argument("table", choices=TABLES)
+        parser.add_argument("path", help="File to read, - for the standard "
+            "input")
+        parser.add_argument("--format", choices=FORMATS,
+            help="Defaults to the extension of the path, else jsonl")
+        parser.add_argument("--batch-size", type=int, default=1000,
+            help="Rows inserted per statement and transaction")
+        parser.add_argument("--on-conflict", choices=("ignore", "update"),
+            default="ignore", help="Keep existing rows or, for posts, "
+            "overwrite them with the imported ones")
+        parser.add_argument("--skip-counters", action="store_true",
+            help="Do not count the likes and follows of the imported rows")
+        parser.add_argument("--skip-timelines", action="store_true",
+            help="Do not backfill the timelines the imported rows reach")
+
+    def database(self, row):
+        """Shard of a post or like, None for follows and unsharded tables"""
+        if "creator_id" in row:
+            # Likes find the shard of their post from its id alone
+            if sharding.shards() and sharding.bucket_of_post(row["id"]) != \
+                    sharding.bucket_of_user(row["creator_id"]):
+                raise CommandError(f"Post {row['id']} does not carry the "
+                    f"bucket of user {row['creator_id']}, sharded databases "
+                    "only import posts exported from a sharded network")
+            return sharding.shard_for_user(row["creator_id"])
+        if "post_id" in row:
+            return sharding.shard_for_post(row["post_id"])
+        return None
+
+    def accepted(self, model, rows):
+        """
+        Rows of a batch that can be imported: posts and likes of existing
+        users, follows between two users. The others are counted as skipped.
+        """
+        if model is Follow:
+            kept = [row for row in rows
+                if row["user_following_id"] != row["user_followed_id"]]
+        else:
+            # Users live in the default database, nothing checks the key
+            column = "creator_id" if model is Post else "user_id"
+            users = set(User.objects.filter(pk__in={row[column]
+                for row in rows}).values_list("id", flat=True))
+            kept = [row for row in rows if row[column] in users]
+        self.skipped += len(rows) - len(kept)
+        return kept
+
+    def conflicts(self, model, columns, on_conflict):
+        if on_conflict == "ignore":
+            return {"ignore_conflicts": True}
+        if model is not Post:
+            raise CommandError("Only posts can be updated, likes and follows "
+                "have nothing to update")
+        return {"update_conflicts": True, "unique_fields": ["id"],
+            "update_fields": [column for column in columns if column != "id"]}
+
+    def imported(self, db, model, rows, options):
+        """
+        Maintain what the model hooks would have for a batch, in its
+        transaction: versions of updated posts, counters and timelines of
+        the posts and users it touches. Creators of posts are backfilled
+        once the import is done.
+        """
+        if model is Post:
+            post_ids = [row["id"] for row in rows]
+            # New versions leave the cached cards of the old content
+            if options["on_conflict"] == "update":
+                Post.objects.using(db).filter(pk__in=post_ids).update(
+                    version=F("version") + 1)
+            self.creators.update(row["creator_id"] for row in rows)
+        elif model is Like and not options["skip_counters"]:
+            Post.objects.using(db).filter(pk__in={row["post_id"]
+                for row in rows}).update(likes_count=count_of(Like, "post"),
+                version=F("version") + 1)
+        elif model is Follow:
+            following = {row["user_following_id"] for row in rows}
+            followed = {row["user_followed_id"] for row in rows}
+            if not options["skip_counters"]:
+                User.objects.filter(pk__in=followed).update(
+                    followers_count=count_of(Follow, "user_followed"))
+                User.objects.filter(pk__in=following).update(
+                    following_count=count_of(Follow, "user_following"),
+                    state_version=F("state_version") + 1)
+                TimelineEntry.objects.pause_fan_out(User.objects.filter(
+                    pk__in=followed))
+            if not options["skip_timelines"]:
+                TimelineEntry.objects.backfill_many(Follow.objects.filter(
+                    user_following__in=following, user_followed__in=followed))
+
+    def reset_sequences(self, model):
+        """Start ids after the imported ones, PostgreSQL keeps a sequence"""
+        for db in databases(model):
+            connection = connections[db or router.db_for_write(model)]
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(),
+                        [model]):
+                    cursor.execute(sql)
+
+    def handle(self, *args, **options):
+        model, columns = TABLES[options["table"]]
+        path = options["path"]
+        format = guess_format(path, options["format"])
+        conflicts = self.conflicts(model, columns, options["on_conflict"])
+        self.creators = set()
+        self.skipped = 0
+
+        count = 0
+        started = time.perf_counter()
+        stream = sys.stdin if path == "-" else open(path, newline="",
+            encoding="utf-8")
+        try:
+            rows = read_rows(stream, format, model, columns)
+            while batch := list(islice(rows, options["batch_size"])):
+                for db, shard_rows in sharding.group_by_shard(
+                        self.accepted(model, batch), self.database).items():
+                    with transaction.atomic(using=db):
+                        model.objects.using(db).bulk_create([model(**row)
+                            for row in shard_rows], **conflicts)
+                        self.imported(db, model, shard_rows, options)
+                count += len(batch)
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"{count} rows sent")
+        except ValueError as error:
+            raise CommandError(f"{error}, {count} rows were imported before")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            if model is Post:
+                self.reset_sequences(model)
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else count
+        self.stdout.write(f"Imported {options['table']}: {count} rows sent "
+            f"in {elapsed:.1f}s ({rate:,.0f} rows/s)")
+        if self.skipped:
+            self.stdout.write(f"Skipped {self.skipped} rows of missing users "
+                "or following themselves")
+
+        # Followers of the creators get their latest posts
+        if not options["skip_timelines"]:
+            creators = iter(sorted(self.creators))
+            while user_ids := list(islice(creators, options["batch_size"])):
+                TimelineEntry.objects.backfill_many(Follow.objects.filter(
+                    user_followed__in=user_ids))
@@ -0,0 +1,167 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F
+
+from network.models import Post, Like, ShardBucket, count_of
+from network.sharding import SHARD_BUCKETS, shard_map, shards
+
+
+def copy_fields(instance):
+    """Unsaved copy of a row, keeping its id"""
+    return type(instance)(**{field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields})
+
+
+class Command(BaseCommand):
+    help = ("Move buckets of users between shards until every shard holds "
+        "about as many posts, e.g. after adding one to NETWORK_SHARD_URLS")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--bucket", type=int, action="append",
+            help="Move this bucket, with --to, instead of planning moves")
+        parser.add_argument("--to", help="Shard receiving --bucket")
+        parser.add_argument("--tolerance", type=float, default=0.1,
+            help="Fraction of the average load a shard may be off by")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true",
+            help="Show the moves without making them")
+
+    def bucket_posts(self, shard, bucket):
+        return Post.objects.using(shard).alias(
+            bucket=F("creator") % SHARD_BUCKETS).filter(bucket=bucket)
+
+    def loads(self, buckets):
+        """Posts of every bucket, read on the shard holding it"""
+        sizes = {bucket: 0 for bucket in range(SHARD_BUCKETS)}
+        for shard in shards():
+            rows = Post.objects.using(shard).annotate(
+                bucket=F("creator") % SHARD_BUCKETS).values(
+                "bucket").annotate(total=Count("id")).order_by()
+            for row in rows:
+                if buckets[row["bucket"]] == shard:
+                    sizes[row["bucket"]] = row["total"]
+        return sizes
+
+    def plan(self, buckets, tolerance):
+        """
+        Moves taking buckets from the fullest shard to the emptiest one,
+        picking the one closing most of the gap, until it is tolerable
+        """
+        buckets = list(buckets)
+        sizes = self.loads(buckets)
+        load = {shard: 0 for shard in shards()}
+        for bucket, size in sizes.items():
+            load[buckets[bucket]] += size
+        allowed = tolerance * sum(load.values()) / len(load)
+        moves = []
+        while True:
+            fullest = max(load, key=load.get)
+            emptiest = min(load, key=load.get)
+            gap = load[fullest] - load[emptiest]
+            candidates = [bucket for bucket in range(SHARD_BUCKETS)
+                if buckets[bucket] == fullest and 0 < sizes[bucket] < gap]
+            if gap <= allowed or not candidates:
+                return moves
+            bucket = min(candidates, key=lambda bucket: abs(
+                gap / 2 - sizes[bucket]))
+            moves.append((bucket, fullest, emptiest, sizes[bucket]))
+            buckets[bucket] = emptiest
+            load[fullest] -= sizes[bucket]
+            load[emptiest] += sizes[bucket]
+
+    def copy(self, bucket, source, target):
+        """
+        Make the bucket on target match source: copy new and edited posts,
+        make their likes the same and drop the posts deleted since
+        """
+        fields = [field.attname for field in Post._meta.concrete_fields
+            if not field.primary_key]
+        posts = self.bucket_posts(source, bucket).order_by("id")
+        last_id = 0
+        while batch := list(posts.filter(id__gt=last_id)[:self.batch_size]):
+            last_id = batch[-1].id
+            post_ids = [post.id for post in batch]
+            with transaction.atomic(using=target):
+                Post.objects.using(target).bulk_create(map(copy_fields,
+                    batch), update_conflicts=True, unique_fields=["id"],
+                    update_fields=fields)
+                # Like ids are local to each shard, compare the pairs
+                likes = {shard: set(Like.objects.using(shard).filter(
+                    post__in=post_ids).values_list("user", "post"))
+                    for shard in (source, target)}
+                Like.objects.using(target).bulk_create([
+                    Like(user_id=user_id, post_id=post_id)
+                    for user_id, post_id in likes[source] - likes[target]
+                ], ignore_conflicts=True)
+                unliked = {}
+                for user_id, post_id in likes[target] - likes[source]:
+                    unliked.setdefault(post_id, []).append(user_id)
+                for post_id, user_ids in unliked.items():
+                    Like.objects.using(target).filter(post=post_id,
+                        user__in=user_ids).delete()
+
+        copied = self.bucket_posts(target, bucket).order_by("id").values_list(
+            "id", flat=True)
+        last_id = 0
+        while post_ids := list(copied.filter(id__gt=last_id)[
+                :self.batch_size]):
+            last_id = post_ids[-1]
+            kept = set(Post.objects.using(source).filter(pk__in=post_ids)
+                .values_list("id", flat=True))
+            deleted = [post_id for post_id in post_ids if post_id not in kept]
+            with transaction.atomic(using=target):
+                Like.objects.using(target).filter(post__in=deleted).delete()
+                Post.objects.using(target).filter(pk__in=deleted).delete()
+
+    def move(self, bucket, source, target):
+        started = time.perf_counter()
+        # Copied while the source still takes the writes
+        self.copy(bucket, source, target)
+        ShardBucket.objects.update_or_create(bucket=bucket,
+            defaults={"shard": target})
+        shard_map.clear()
+        # Every process reads the new map by then, bring over what they
+        # wrote, edited or removed meanwhile
+        time.sleep(getattr(settings, "NETWORK_SHARD_MAP_TTL", 5))
+        self.copy(bucket, source, target)
+        moved = self.bucket_posts(target, bucket)
+        moved.update(likes_count=count_of(Like, "post"))
+
+        posts = self.bucket_posts(source, bucket)
+        with transaction.atomic(using=source):
+            Like.objects.using(source).filter(post__in=posts.values(
+                "id")).delete()
+            posts.delete()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"Bucket {bucket}: {source} -> {target}, "
+            f"{moved.count()} posts in {elapsed:.1f}s")
+
+    def handle(self, *args, **options):
+        aliases = shards()
+        if len(aliases) < 2:
+            raise CommandError("Set NETWORK_SHARD_URLS to two shards or more")
+        self.batch_size = options["batch_size"]
+        shard_map.clear()
+        buckets = shard_map.buckets()
+
+        if options["bucket"]:
+            if options["to"] not in aliases:
+                raise CommandError(f"--to should be one of "
+                    f"{', '.join(aliases)}")
+            moves = [(bucket, buckets[bucket], options["to"], None)
+                for bucket in options["bucket"]
+                if buckets[bucket] != options["to"]]
+        else:
+            moves = self.plan(buckets, options["tolerance"])
+
+        if not moves:
+            self.stdout.write("Shards are balanced")
+        for bucket, source, target, size in moves:
+            if options["dry_run"]:
+                self.stdout.write(f"Bucket {bucket}: {source} -> {target}"
+                    + (f", {size} posts" if size is not None else ""))
+            else:
+                self.move(bucket, source, target)
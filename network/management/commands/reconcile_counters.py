@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+
+from network.models import (User, Post, Follow, Like, TimelineEntry,
+    count_of)
+from network.transfer import databases
+
+
+def reconcile(queryset, field, actual, batch_size):
+    """
+    Rewrite the stored counter of every row where it drifted from the real
+    value, walking the table of the queryset's database batch_size ids at a
+    time to keep transactions short. Sharded post ids are far apart, the
+    walk follows the ids there are.
+    """
+    fixed = 0
+    last = -1
+    while ids := list(queryset.filter(id__gt=last).order_by("id").values_list(
+            "id", flat=True)[:batch_size]):
+        batch = queryset.filter(id__gte=ids[0], id__lte=ids[-1])
+        with transaction.atomic(using=queryset.db):
+            fixed += batch.exclude(**{field: actual}).update(
+                **{field: actual})
+        last = ids[-1]
+    return fixed
+
+
+class Command(BaseCommand):
+    help = "Rebuild stored like and follow counters from their tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000,
+            help="Number of ids reconciled per transaction")
+
+    def handle(self, *args, **options):
+        # Likes are stored on the shard of their post
+        fixed = sum(reconcile(Post.objects.using(db or router.db_for_write(
+            Post)), "likes_count", count_of(Like, "post"),
+            options["batch_size"]) for db in databases(Post))
+        self.stdout.write(f"Posts likes_count fixed: {fixed}")
+
+        for field, column in (("followers_count", "user_followed"),
+                ("following_count", "user_following")):
+            fixed = reconcile(User.objects.using(router.db_for_write(User)),
+                field, count_of(Follow, column), options["batch_size"])
+            self.stdout.write(f"Users {field} fixed: {fixed}")
+
+        # Rebuilt counters may cross the fan-out limits
+        TimelineEntry.objects.pause_fan_out(User.objects.all())
+        TimelineEntry.objects.resume_fan_out(User.objects.all())
@@ -0,0 +1,52 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from network import jobs
+
+
+class Command(BaseCommand):
+    help = ("Run the deferred jobs queued in the database, batching jobs "
+        "of the same name and retrying failed ones")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true",
+            help="Exit when no job is due instead of waiting for more")
+        parser.add_argument("--name", action="append",
+            help="Only run jobs with this name")
+        parser.add_argument("--batch-size", type=int, default=100,
+            help="Jobs of the same name run by one handler call")
+        parser.add_argument("--lease", type=int, default=300,
+            help="Seconds a batch stays claimed by this worker")
+        parser.add_argument("--poll", type=float, default=1,
+            help="Seconds to wait when no job is due")
+        parser.add_argument("--keep-days", type=float, default=7,
+            help="Days done jobs, and their idempotency keys, are kept")
+
+    def handle(self, *args, **options):
+        keep = timedelta(days=options["keep_days"])
+        done = failed = 0
+        while True:
+            claimed = jobs.claim(options["batch_size"], options["lease"],
+                options["name"])
+            if not claimed:
+                purged = jobs.purge(keep)
+                if purged:
+                    self.stdout.write(f"Purged {purged} done jobs")
+                if options["once"]:
+                    break
+                # Like a request, drop connections that went stale
+                close_old_connections()
+                time.sleep(options["poll"])
+                continue
+
+            started = time.perf_counter()
+            succeeded = jobs.execute(claimed)
+            elapsed = time.perf_counter() - started
+            done += succeeded
+            failed += len(claimed) - succeeded
+            self.stdout.write(f"{claimed[0].name}: {succeeded} of "
+                f"{len(claimed)} jobs in {elapsed * 1000:.1f}ms")
+        self.stdout.write(f"Jobs done: {done}, failed: {failed}")
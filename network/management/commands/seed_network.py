@@ -0,0 +1,156 @@
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from contextlib import ExitStack
+from itertools import accumulate, islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from network import sharding
+from network.models import User, Post, Follow, Like, TimelineEntry
+from network.transfer import databases
+
+
+def power_law(size, skew):
+    """Cumulative weights where the n-th item weighs 1 / n ** skew"""
+    return list(accumulate(1 / (rank ** skew) for rank in range(1, size + 1)))
+
+
+class Command(BaseCommand):
+    help = "Fill the database with a large, skewed synthetic dataset"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--posts", type=int, default=10000)
+        parser.add_argument("--follows", type=int, default=20000)
+        parser.add_argument("--likes", type=int, default=100000)
+        parser.add_argument("--skew", type=float, default=1.1,
+            help="Power-law exponent for followers and hot posts")
+        parser.add_argument("--days", type=int, default=365,
+            help="Spread posts created_at over this many days")
+        parser.add_argument("--until", type=datetime.fromisoformat,
+            help="Newest created_at, defaults to today at midnight UTC")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--skip-timelines", action="store_true",
+            help="Do not backfill the following timelines")
+
+    def _bulk(self, model, rows, locate=lambda row: None, **kwargs):
+        """
+        Insert rows in batches, each on the shard locate(row) returns,
+        returns how many were sent
+        """
+        total = 0
+        rows = iter(rows)
+        with ExitStack() as stack:
+            for db in databases(model):
+                stack.enter_context(transaction.atomic(using=db))
+            while batch := list(islice(rows, self.batch_size)):
+                for db, shard_rows in sharding.group_by_shard(batch,
+                        locate).items():
+                    model.objects.using(db).bulk_create(shard_rows, **kwargs)
+                total += len(batch)
+        return total
+
+    def _posts(self, creators, until, spread, rng, post_ids):
+        """Posts of the creators, their ids drawn on sharded databases"""
+        for n, creator in enumerate(creators):
+            post = Post(content=f"Seeded post {n}", creator_id=creator,
+                created_at=until - timedelta(seconds=rng.random() * spread))
+            if sharding.shards():
+                post.id = sharding.new_post_id(creator, post.created_at)
+                post_ids.append(post.id)
+            yield post
+
+    def _report(self, label, count, started):
+        elapsed = time.perf_counter() - started
+        rate = count / elapsed if elapsed else count
+        self.stdout.write(f"{label}: {count} rows sent in {elapsed:.1f}s "
+            f"({rate:,.0f} rows/s)")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        skew = options["skew"]
+        until = options["until"] or datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        if until.tzinfo is None:
+            until = until.replace(tzinfo=timezone.utc)
+        spread = timedelta(days=options["days"]).total_seconds()
+
+        # Users, sharing one password hash as hashing dominates otherwise
+        started = time.perf_counter()
+        first = (User.objects.aggregate(Max("id"))["id__max"] or 0) + 1
+        password = make_password("seed")
+        count = self._bulk(User, (
+            User(username=f"seed{n}", email=f"seed{n}@example.com",
+                password=password)
+            for n in range(first, first + options["users"])
+        ))
+        user_ids = list(User.objects.filter(id__gte=first).order_by(
+            "id").values_list("id", flat=True))
+        self._report("Users", count, started)
+        if not user_ids:
+            return
+
+        # Users ranked by popularity, the first ones get most followers
+        popular = user_ids[:]
+        rng.shuffle(popular)
+        popular_weights = power_law(len(popular), skew)
+
+        # Posts, popular users post more and created_at spreads over days.
+        # On shards they go to the shard of their creator.
+        started = time.perf_counter()
+        creators = rng.choices(popular, cum_weights=power_law(len(popular),
+            skew / 2), k=options["posts"])
+        post_ids = []
+        if not sharding.shards():
+            first = (Post.objects.aggregate(Max("id"))["id__max"] or 0) + 1
+        count = self._bulk(Post, self._posts(creators, until, spread, rng,
+            post_ids), lambda post: sharding.shard_for_user(post.creator_id))
+        if not sharding.shards():
+            post_ids = list(Post.objects.filter(id__gte=first).order_by(
+                "id").values_list("id", flat=True))
+        self._report("Posts", count, started)
+
+        # Follows, followed users follow a power law
+        started = time.perf_counter()
+        followed = rng.choices(popular, cum_weights=popular_weights,
+            k=options["follows"])
+        count = self._bulk(Follow, (
+            Follow(user_following_id=follower, user_followed_id=user)
+            for follower, user in zip(
+                rng.choices(user_ids, k=options["follows"]), followed)
+            if follower != user
+        ), ignore_conflicts=True)
+        self._report("Follows", count, started)
+
+        # Likes, a few hot posts get most of them
+        if post_ids:
+            started = time.perf_counter()
+            rng.shuffle(post_ids)
+            post_weights = power_law(len(post_ids), skew)
+            count = 0
+            for start in range(0, options["likes"], self.batch_size):
+                size = min(self.batch_size, options["likes"] - start)
+                count += self._bulk(Like, (
+                    Like(user_id=user, post_id=post)
+                    for user, post in zip(rng.choices(user_ids, k=size),
+                        rng.choices(post_ids, cum_weights=post_weights,
+                        k=size))
+                ), lambda like: sharding.shard_for_post(like.post_id),
+                    ignore_conflicts=True)
+            self._report("Likes", count, started)
+
+        # Bulk inserts skip the model hooks, rebuild what they maintain
+        started = time.perf_counter()
+        call_command("reconcile_counters", batch_size=self.batch_size,
+            stdout=self.stdout)
+        if not options["skip_timelines"]:
+            TimelineEntry.objects.backfill_many(Follow.objects.all())
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"Counters and timelines rebuilt in {elapsed:.1f}s")
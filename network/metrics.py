@@ -0,0 +1,224 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+
+# Other request methods are counted together, keeping the labels bounded
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class Registry:
+    """
+    Counters and histograms for the /metrics endpoint.
+
+    Every thread records into its own shard, so recording takes no lock and
+    shards are only merged when metrics are read. Shards of finished
+    threads, like the one ASGI starts per request, are folded into the
+    process totals and released. With the
+    NETWORK_METRICS_DIR setting each process also dumps its totals there,
+    so any worker can serve the metrics of all of them.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self._local = threading.local()
+        # (thread, shard) of every thread recording
+        self._shards = []
+        # Values of the threads that finished
+        self._retired = {}
+        self._lock = threading.Lock()
+        self._last_dump = 0.0
+
+    def counter(self, name, documentation):
+        return self._register(Counter(self, name, documentation))
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, buckets))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def shard(self):
+        """Values recorded by the current thread"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire(self):
+        """Fold the shards of finished threads, called with the lock held"""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+                continue
+            for key, value in shard.items():
+                add(self._retired, key, list(value))
+        self._shards = alive
+
+    def snapshot(self):
+        """Merge the shards of every thread of this process"""
+        with self._lock:
+            self._retire()
+            totals = {key: list(value)
+                for key, value in self._retired.items()}
+            shards = [shard for thread, shard in self._shards]
+        for shard in shards:
+            # Copying is atomic, the owner thread may keep recording
+            for key, value in shard.copy().items():
+                add(totals, key, list(value))
+        return totals
+
+    def dump(self, force=False):
+        """Write this process totals to NETWORK_METRICS_DIR once a second"""
+        directory = getattr(settings, "NETWORK_METRICS_DIR", None)
+        now = time.monotonic()
+        if not directory or (not force and now - self._last_dump < 1):
+            return
+        self._last_dump = now
+        path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+        snapshot = [[list(key), value] for key, value in
+            self.snapshot().items()]
+        with open(f"{path}.tmp", "w") as dump:
+            json.dump(snapshot, dump)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """Totals of every process sharing NETWORK_METRICS_DIR"""
+        directory = getattr(settings, "NETWORK_METRICS_DIR", None)
+        if not directory:
+            return self.snapshot()
+        self.dump(force=True)
+        totals = {}
+        for path in glob.glob(os.path.join(directory, "metrics-*.json")):
+            try:
+                with open(path) as dump:
+                    snapshot = json.load(dump)
+            except (OSError, ValueError):
+                continue
+            for (name, labels), value in snapshot:
+                add(totals, (name, tuple(tuple(pair) for pair in labels)),
+                    value)
+        return totals
+
+    def render(self):
+        """Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            samples = sorted((key[1], value) for key, value in totals.items()
+                if key[0] == name)
+            for labels, value in samples:
+                lines.extend(metric.samples(dict(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def add(totals, key, value):
+    """Add a shard value into the merged totals"""
+    if key in totals:
+        totals[key] = [a + b for a, b in zip(totals[key], value)]
+    else:
+        totals[key] = value
+
+
+def label_key(name, labels):
+    """Shard key of a metric with the given labels"""
+    return (name, tuple(sorted((label, str(value))
+        for label, value in labels.items())))
+
+
+def escape(value):
+    """Label value escaped for the text exposition format"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"'
+        for name, value in labels.items())
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, registry, name, documentation):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.name, labels)
+        shard = self.registry.shard()
+        if key in shard:
+            shard[key][0] += amount
+        else:
+            shard[key] = [amount]
+
+    def samples(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {value[0]}"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, registry, name, documentation, buckets):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+
+    def observe(self, amount, **labels):
+        key = label_key(self.name, labels)
+        shard = self.registry.shard()
+        # Bucket counts followed by the sum and the count
+        value = shard.get(key)
+        if value is None:
+            value = shard[key] = [0] * (len(self.buckets) + 3)
+        value[bisect_left(self.buckets, amount)] += 1
+        value[-2] += amount
+        value[-1] += 1
+
+    def samples(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), value):
+            cumulative += count
+            bucket_labels = format_labels({**labels, "le": bound})
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {value[-2]}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {value[-1]}")
+        return lines
+
+
+registry = Registry()
+
+requests_total = registry.counter("network_requests_total",
+    "Requests served by URL name, method and status")
+request_duration = registry.histogram("network_request_duration_seconds",
+    "Request latency by URL name")
+db_queries = registry.histogram("network_db_queries_per_request",
+    "Database queries per request by URL name", QUERY_COUNT_BUCKETS)
+db_query_duration = registry.histogram("network_db_query_duration_seconds",
+    "Database statement latency")
+posts_created = registry.counter("network_posts_created_total",
+    "Posts created")
+likes_toggled = registry.counter("network_likes_toggled_total",
+    "Likes added or removed")
+follows_changed = registry.counter("network_follows_changed_total",
+    "Follows added or removed")
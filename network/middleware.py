@@ -0,0 +1,175 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import metrics
+from .routers import PrimaryPin, pinned_to_primary
+from .timing import RequestTiming, current_timing, observing_queries
+
+
+logger = logging.getLogger("network.sql")
+
+
+class ServerTimingMiddleware:
+    """
+    Add a Server-Timing header with the query count, database, view and
+    template time of each request, and log its slowest SQL statements.
+    Enabled by the NETWORK_SERVER_TIMING setting.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "NETWORK_SERVER_TIMING", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_query_seconds = getattr(settings, "NETWORK_SLOW_QUERY_MS",
+            100) / 1000
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timing = RequestTiming(self.slow_query_seconds)
+        token = current_timing.set(timing)
+        started = time.perf_counter()
+        try:
+            with observing_queries(timing):
+                response = self.get_response(request)
+        finally:
+            current_timing.reset(token)
+        return self.add_header(request, response, timing, started)
+
+    async def __acall__(self, request):
+        timing = RequestTiming(self.slow_query_seconds)
+        token = current_timing.set(timing)
+        started = time.perf_counter()
+        try:
+            with observing_queries(timing):
+                response = await self.get_response(request)
+        finally:
+            current_timing.reset(token)
+        return self.add_header(request, response, timing, started)
+
+    def add_header(self, request, response, timing, started):
+        total = time.perf_counter() - started
+        view_name = getattr(request.resolver_match, "view_name", request.path)
+        for elapsed, sql in sorted(timing.slow_queries, reverse=True):
+            logger.warning("Slow query in %s (%.1fms): %s", view_name,
+                elapsed * 1000, sql)
+
+        response["Server-Timing"] = ", ".join([
+            f'db;dur={timing.db_time * 1000:.1f};desc="{timing.queries} '
+            f'queries"',
+            f"view;dur={(total - timing.template_time) * 1000:.1f}",
+            f"tpl;dur={timing.template_time * 1000:.1f}",
+            f"total;dur={total * 1000:.1f}",
+        ])
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """
+    Keep the reads of a browser on the primary database for
+    NETWORK_REPLICA_PIN_SECONDS after it writes, so replication lag does not
+    hide its own changes. Unused without NETWORK_DB_REPLICAS.
+    """
+    sync_capable = True
+    async_capable = True
+    cookie_name = "network_primary"
+
+    def __init__(self, get_response):
+        if not getattr(settings, "NETWORK_DB_REPLICAS", None):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        pinned = self.cookie_name in request.COOKIES
+        pin = PrimaryPin(pinned or self.writes(request))
+        token = pinned_to_primary.set(pin)
+        try:
+            with observing_queries(pin):
+                response = self.get_response(request)
+            return self.pin(request, response, pinned, pin)
+        finally:
+            pinned_to_primary.reset(token)
+
+    async def __acall__(self, request):
+        pinned = self.cookie_name in request.COOKIES
+        pin = PrimaryPin(pinned or self.writes(request))
+        token = pinned_to_primary.set(pin)
+        try:
+            with observing_queries(pin):
+                response = await self.get_response(request)
+            return self.pin(request, response, pinned, pin)
+        finally:
+            pinned_to_primary.reset(token)
+
+    def writes(self, request):
+        return request.method not in ("GET", "HEAD", "OPTIONS")
+
+    def pin(self, request, response, pinned, pin):
+        """Pin the next reads when this request wrote"""
+        if self.writes(request) or (pin.pinned and not pinned):
+            response.set_cookie(self.cookie_name, "1",
+                max_age=settings.NETWORK_REPLICA_PIN_SECONDS, httponly=True,
+                samesite="Lax")
+        return response
+
+
+class QueryMetrics:
+    """Query observer feeding the query metrics of a request"""
+    def __init__(self):
+        self.queries = 0
+
+    def observe(self, elapsed, sql):
+        metrics.db_query_duration.observe(elapsed)
+        self.queries += 1
+
+
+class MetricsMiddleware:
+    """Record request counters and latency histograms for /metrics"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryMetrics()
+        started = time.perf_counter()
+        with observing_queries(queries):
+            response = self.get_response(request)
+        return self.record(request, response, queries, started)
+
+    async def __acall__(self, request):
+        queries = QueryMetrics()
+        started = time.perf_counter()
+        with observing_queries(queries):
+            response = await self.get_response(request)
+        return self.record(request, response, queries, started)
+
+    def record(self, request, response, queries, started):
+        elapsed = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else "unmatched"
+        method = request.method if request.method in metrics.METHODS \
+            else "other"
+        metrics.requests_total.inc(view=view, method=method,
+            status=response.status_code)
+        metrics.request_duration.observe(elapsed, view=view)
+        metrics.db_queries.observe(queries.queries, view=view)
+        metrics.registry.dump()
+        return response
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 18:51
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    Post = apps.get_model("network", "Post")
+    Like = apps.get_model("network", "Like")
+    likes = Like.objects.filter(post=OuterRef("pk")).order_by().values(
+        "post").annotate(total=Count("id")).values("total")
+    Post.objects.update(likes_count=Coalesce(Subquery(likes), 0))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0006_alter_like_unique_together_remove_like_like"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="post",
+            name="likes_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
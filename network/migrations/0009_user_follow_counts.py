@@ -0,0 +1,42 @@
+# Generated by Django 5.0.2 on 2026-10-18 18:57
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_follows(apps, schema_editor):
+    User = apps.get_model("network", "User")
+    Follow = apps.get_model("network", "Follow")
+    for field, column in (
+        ("followers_count", "user_followed"),
+        ("following_count", "user_following"),
+    ):
+        follows = (
+            Follow.objects.filter(**{column: OuterRef("pk")})
+            .order_by()
+            .values(column)
+            .annotate(total=Count("id"))
+            .values("total")
+        )
+        User.objects.update(**{field: Coalesce(Subquery(follows), 0)})
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0008_timelineentry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="followers_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="following_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_follows, migrations.RunPython.noop),
+    ]
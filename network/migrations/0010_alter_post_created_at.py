@@ -0,0 +1,20 @@
+# Generated by Django 5.0.2 on 2026-10-18 18:58
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0009_user_follow_counts"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="post",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.2 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0011_post_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="state_version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.2 on 2026-10-18 19:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0012_user_state_version"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(fields=["-created_at", "-id"], name="post_recent_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="post",
+            index=models.Index(
+                fields=["creator", "-created_at", "-id"], name="post_creator_recent_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.0.2 on 2026-10-18 19:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0013_post_feed_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ShardBucket",
+            fields=[
+                (
+                    "bucket",
+                    models.PositiveSmallIntegerField(primary_key=True, serialize=False),
+                ),
+                ("shard", models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="like",
+            name="user",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="post",
+            name="creator",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="posts",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="post",
+            name="id",
+            field=models.BigAutoField(primary_key=True, serialize=False),
+        ),
+    ]
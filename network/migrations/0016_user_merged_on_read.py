@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 21:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_high_followers(apps, schema_editor):
+    User = apps.get_model("network", "User")
+    User.objects.filter(
+        followers_count__gte=getattr(
+            settings, "NETWORK_FANOUT_FOLLOWER_LIMIT", 10000
+        )
+    ).update(merged_on_read=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("network", "0015_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="merged_on_read",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_high_followers, migrations.RunPython.noop),
+    ]
@@ -1,18 +1,149 @@
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import (IntegrityError, connections, models, router,
+    transaction)
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import sharding
+
+# Accounts with this many followers skip fan-out, read-time merged instead
+FANOUT_FOLLOWER_LIMIT = getattr(settings, "NETWORK_FANOUT_FOLLOWER_LIMIT",
+    10000)
+# They fan out again below this many, churn at the limit switches nothing
+FANOUT_RESUME_LIMIT = getattr(settings, "NETWORK_FANOUT_RESUME_LIMIT",
+    FANOUT_FOLLOWER_LIMIT * 9 // 10)
+# Posts copied into a timeline when a new follow is made
+TIMELINE_BACKFILL = getattr(settings, "NETWORK_TIMELINE_BACKFILL", 200)
+TIMELINE_BATCH_SIZE = 1000
+# Attempts to draw an unused id for a post on a sharded database
+POST_ID_ATTEMPTS = 5
+# Leave timeline deliveries and trims to the run_jobs worker
+DEFER_WORK = getattr(settings, "NETWORK_DEFER_WORK", False)
+
+
+def returning_ids(db, sql, params):
+    """Ids returned by a write, one per row it changed"""
+    with connections[db].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+
+def count_of(model, field):
+    """Subquery counting the rows of model pointing to the outer row"""
+    return Coalesce(Subquery(model.objects.filter(**{field: OuterRef("pk")})
+        .order_by().values(field).annotate(total=Count("pk")).values(
+        "total")), 0)
 
 
 class User(AbstractUser):
     """List of registered users"""
-    pass
+    # Kept in sync by Follow.save() and Follow.delete()
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    # Bumped on every follow or unfollow made by the user
+    state_version = models.PositiveIntegerField(default=1)
+    # Posts merged into the following feed when read instead of fanned out,
+    # see TimelineManager.pause_fan_out()
+    merged_on_read = models.BooleanField(default=False)
 
 class Post(models.Model):
     """Posts made by users"""
+    # Big enough for the ids given on sharded databases, see new_post_id()
+    id = models.BigAutoField(primary_key=True)
     content = models.TextField()
-    creator = models.ForeignKey(User, on_delete=models.CASCADE, 
-        related_name="posts")
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Users stay in the default database when posts go to shards
+    creator = models.ForeignKey(User, on_delete=models.CASCADE,
+        related_name="posts", db_constraint=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    # Kept in sync by Like.save() and Like.delete()
+    likes_count = models.PositiveIntegerField(default=0)
+    # Bumped on every edit or like, it keys the cached post card
+    version = models.PositiveIntegerField(default=1)
+
+    def save(self, *args, **kwargs):
+        """
+        Deliver new posts to the timelines of the creator's followers, edits
+        bump the version. On shards new posts draw an id carrying the
+        bucket of their creator.
+        """
+        adding = self._state.adding
+        if not adding:
+            self.version = F("version") + 1
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+        kwargs["using"] = kwargs.get("using") or router.db_for_write(Post,
+            instance=self)
+        new_id = adding and self.id is None and bool(sharding.shards())
+        for attempt in range(1, POST_ID_ATTEMPTS + 1):
+            if new_id:
+                self.id = sharding.new_post_id(self.creator_id,
+                    self.created_at)
+            try:
+                with transaction.atomic(using=kwargs["using"]):
+                    super().save(*args, **kwargs)
+                    if adding and DEFER_WORK:
+                        Job.objects.enqueue("fan_out", {"post": self.id},
+                            key=f"fan_out:{self.id}")
+                    elif adding:
+                        TimelineEntry.objects.fan_out(self)
+                break
+            except IntegrityError:
+                if not new_id or attempt == POST_ID_ATTEMPTS:
+                    raise
+        if not adding:
+            self.refresh_from_db(fields=["version"])
+
+    class Meta:
+        """Indexes reading the feeds newest first, see explain_feeds"""
+        indexes = [
+            models.Index(fields=["-created_at", "-id"],
+                name="post_recent_idx"),
+            models.Index(fields=["creator", "-created_at", "-id"],
+                name="post_creator_recent_idx"),
+        ]
+
+class FollowManager(models.Manager):
+    """
+    Follows and unfollows in bulk, returning the users whose follow changed
+    so the caller moves the counters by that much
+    """
+    def _tables(self, connection):
+        return {
+            "follow": connection.ops.quote_name(self.model._meta.db_table),
+            "user": connection.ops.quote_name(User._meta.db_table),
+        }
+
+    def follow_many(self, user_id, user_ids):
+        """Follow the existing users not followed yet, except oneself"""
+        if not user_ids:
+            return []
+        db = self._db or router.db_for_write(self.model)
+        return returning_ids(db, "INSERT INTO {follow} (user_following_id, "
+            "user_followed_id) SELECT %s, id FROM {user} WHERE id IN ({ids}) "
+            "AND id <> %s ON CONFLICT DO NOTHING RETURNING user_followed_id"
+            .format(ids=placeholders(user_ids),
+            **self._tables(connections[db])), [user_id, *user_ids, user_id])
+
+    def unfollow_many(self, user_id, user_ids):
+        """Unfollow the users followed"""
+        if not user_ids:
+            return []
+        db = self._db or router.db_for_write(self.model)
+        return returning_ids(db, "DELETE FROM {follow} WHERE "
+            "user_following_id = %s AND user_followed_id IN ({ids}) "
+            "RETURNING user_followed_id".format(ids=placeholders(user_ids),
+            **self._tables(connections[db])), [user_id, *user_ids])
+
 
 class Follow(models.Model):
     """Relation between users following each other"""
@@ -20,6 +151,8 @@ class Follow(models.Model):
         related_name="following_list")
     user_followed = models.ForeignKey(User, on_delete=models.CASCADE, 
         related_name="followers_list")
+
+    objects = FollowManager()
     
     def follow_is_valid(self):
         """Following user can't be followed user at the same time"""
@@ -29,20 +162,425 @@ class Follow(models.Model):
     
     def __str__(self):
         return f"{self.user_following} is following {self.user_followed}"
+
+    def job_payload(self):
+        return {"user": self.user_following_id,
+            "followed": self.user_followed_id}
+
+    def _update_counts(self, step):
+        """Move both users follow counters by step"""
+        User.objects.filter(pk=self.user_following_id).update(
+            following_count=F("following_count") + step,
+            state_version=F("state_version") + 1)
+        User.objects.filter(pk=self.user_followed_id).update(
+            followers_count=F("followers_count") + step)
+
+    def save(self, *args, **kwargs):
+        """
+        Increase the follow counters and copy recent posts of the followed
+        user into the timeline
+        """
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                self._update_counts(1)
+                TimelineEntry.objects.pause_fan_out(User.objects.filter(
+                    pk=self.user_followed_id))
+                if DEFER_WORK:
+                    Job.objects.enqueue("backfill", self.job_payload(),
+                        key=f"backfill:{self.id}")
+                else:
+                    TimelineEntry.objects.backfill(self)
+
+    def delete(self, *args, **kwargs):
+        """
+        Decrease the follow counters and remove posts of the unfollowed user
+        from the timeline
+        """
+        key = f"trim:{self.id}"
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            # A concurrent unfollow may have deleted the row first
+            if not result[1].get(self._meta.label):
+                return result
+            self._update_counts(-1)
+            if DEFER_WORK:
+                Job.objects.enqueue("trim", self.job_payload(), key=key)
+            else:
+                TimelineEntry.objects.trim(self)
+            TimelineEntry.objects.resume_fan_out(User.objects.filter(
+                pk=self.user_followed_id))
+        return result
     
     class Meta:
         """ Avoid repetetion as each following is unique"""
         unique_together = ("user_following", "user_followed")
 
+class LikeManager(models.Manager):
+    """
+    Idempotent like and unlike. Each one is a conditional write that
+    returns the new likes count along with whether anything changed, or
+    None when the post does not exist. PostgreSQL runs it as a single
+    statement, other databases as the write plus the counter update.
+    """
+    def _tables(self, connection):
+        return {
+            "like": connection.ops.quote_name(self.model._meta.db_table),
+            "post": connection.ops.quote_name(Post._meta.db_table),
+        }
+
+    def _change(self, write, single, step, user_id, post_id):
+        # Writes, even when raw, go where the routers send them
+        db = self._db or sharding.shard_for_post(post_id) or \
+            router.db_for_write(self.model)
+        connection = connections[db]
+        tables = self._tables(connection)
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(single.format(**tables), [user_id, post_id,
+                    post_id])
+                return cursor.fetchone()
+            cursor.execute(write.format(**tables), [user_id, post_id])
+            changed = cursor.rowcount > 0
+            if changed:
+                cursor.execute(
+                    "UPDATE {post} SET likes_count = likes_count + %s, "
+                    "version = version + 1 WHERE id = %s "
+                    "RETURNING likes_count".format(**tables), [step, post_id])
+            else:
+                cursor.execute("SELECT likes_count FROM {post} "
+                    "WHERE id = %s".format(**tables), [post_id])
+            row = cursor.fetchone()
+        return row and (row[0], changed)
+
+    def like(self, user_id, post_id):
+        """Add a like unless it is there, returns (likes_count, liked)"""
+        return self._change(
+            "INSERT INTO {like} (user_id, post_id) SELECT %s, id FROM {post} "
+            "WHERE id = %s ON CONFLICT DO NOTHING",
+            "WITH added AS (INSERT INTO {like} (user_id, post_id) "
+            "SELECT %s, id FROM {post} WHERE id = %s ON CONFLICT DO NOTHING "
+            "RETURNING post_id), "
+            "counted AS (UPDATE {post} SET likes_count = likes_count + 1, "
+            "version = version + 1 WHERE id IN (SELECT post_id FROM added) "
+            "RETURNING likes_count) "
+            "SELECT likes_count, true FROM counted UNION ALL "
+            "SELECT likes_count, false FROM {post} WHERE id = %s "
+            "AND NOT EXISTS (SELECT 1 FROM added)",
+            1, user_id, post_id)
+
+    def unlike(self, user_id, post_id):
+        """Remove a like if it is there, returns (likes_count, unliked)"""
+        return self._change(
+            "DELETE FROM {like} WHERE user_id = %s AND post_id = %s",
+            "WITH removed AS (DELETE FROM {like} WHERE user_id = %s "
+            "AND post_id = %s RETURNING post_id), "
+            "counted AS (UPDATE {post} SET likes_count = likes_count - 1, "
+            "version = version + 1 WHERE id IN (SELECT post_id FROM removed) "
+            "RETURNING likes_count) "
+            "SELECT likes_count, true FROM counted UNION ALL "
+            "SELECT likes_count, false FROM {post} WHERE id = %s "
+            "AND NOT EXISTS (SELECT 1 FROM removed)",
+            -1, user_id, post_id)
+
+    def toggle(self, user_id, post_id):
+        """Like a post, or unlike it when it was liked already"""
+        result = self.like(user_id, post_id)
+        if result and not result[1]:
+            # None when the post was deleted in between
+            result = self.unlike(user_id, post_id)
+            return result and (result[0], False)
+        return result
+
+    async def alike(self, user_id, post_id):
+        return await sync_to_async(self.like)(user_id, post_id)
+
+    async def aunlike(self, user_id, post_id):
+        return await sync_to_async(self.unlike)(user_id, post_id)
+
+    async def atoggle(self, user_id, post_id):
+        return await sync_to_async(self.toggle)(user_id, post_id)
+
+    def like_many(self, user_id, post_ids):
+        """
+        Add the likes missing on existing posts, returns the posts liked.
+        The caller moves their counters.
+        """
+        if not post_ids:
+            return []
+        db = self._db or router.db_for_write(self.model)
+        return returning_ids(db, "INSERT INTO {like} (user_id, post_id) "
+            "SELECT %s, id FROM {post} WHERE id IN ({ids}) "
+            "ON CONFLICT DO NOTHING RETURNING post_id".format(
+            ids=placeholders(post_ids), **self._tables(connections[db])),
+            [user_id, *post_ids])
+
+    def unlike_many(self, user_id, post_ids):
+        """Remove the likes there are, returns the posts unliked"""
+        if not post_ids:
+            return []
+        db = self._db or router.db_for_write(self.model)
+        return returning_ids(db, "DELETE FROM {like} WHERE user_id = %s "
+            "AND post_id IN ({ids}) RETURNING post_id".format(
+            ids=placeholders(post_ids), **self._tables(connections[db])),
+            [user_id, *post_ids])
+
 class Like(models.Model):
-    """Likes made by users on posts"""
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    """Likes made by users on posts, stored on the shard of the post"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+        db_constraint=False)
     post = models.ForeignKey(Post, on_delete=models.CASCADE,
         related_name="post_likes")
+
+    objects = LikeManager()
     
     def __str__(self):
         return f"{self.user} liked post n°{self.post.id}."
+
+    def save(self, *args, **kwargs):
+        """Increase the post likes counter along with the new like"""
+        adding = self._state.adding
+        kwargs["using"] = kwargs.get("using") or router.db_for_write(Like,
+            instance=self)
+        with transaction.atomic(using=kwargs["using"]):
+            super().save(*args, **kwargs)
+            if adding:
+                Post.objects.using(kwargs["using"]).filter(
+                    pk=self.post_id).update(
+                    likes_count=F("likes_count") + 1,
+                    version=F("version") + 1)
+
+    def delete(self, *args, **kwargs):
+        """Decrease the post likes counter along with the deleted like"""
+        kwargs["using"] = kwargs.get("using") or router.db_for_write(Like,
+            instance=self)
+        with transaction.atomic(using=kwargs["using"]):
+            result = super().delete(*args, **kwargs)
+            # A concurrent unlike may have deleted the row first
+            if not result[1].get(self._meta.label):
+                return result
+            Post.objects.using(kwargs["using"]).filter(
+                pk=self.post_id).update(
+                likes_count=F("likes_count") - 1,
+                version=F("version") + 1)
+        return result
         
     class Meta:
         """Avoid repetition as each like yo each post is unique"""
-        unique_together = ("user", "post")
\ No newline at end of file
+        unique_together = ("user", "post")
+
+class TimelineManager(models.Manager):
+    """
+    Fan-out on write for the following feed. Sharded databases merge the
+    posts of the followed users when the feed is read instead.
+    """
+    def is_high_follower(self, user_id):
+        """Whether a user has too many followers to fan out its posts"""
+        return User.objects.filter(pk=user_id, merged_on_read=True).exists()
+
+    def pause_fan_out(self, users):
+        """
+        Merge the posts of the users reaching FANOUT_FOLLOWER_LIMIT when
+        their followers read the feed, instead of fanning them out
+        """
+        users.filter(merged_on_read=False,
+            followers_count__gte=FANOUT_FOLLOWER_LIMIT).update(
+            merged_on_read=True)
+
+    def resume_fan_out(self, users):
+        """
+        Fan out again the posts of the users back below FANOUT_RESUME_LIMIT.
+        Their posts were never delivered while they were merged, a
+        restore_fan_out job backfills the timelines of their followers.
+        """
+        resumed = list(users.filter(merged_on_read=True,
+            followers_count__lt=FANOUT_RESUME_LIMIT).values_list("id",
+            flat=True))
+        if not resumed:
+            return
+        User.objects.filter(pk__in=resumed).update(merged_on_read=False)
+        Job.objects.enqueue_many("restore_fan_out", [{"followed": user_id}
+            for user_id in resumed])
+
+    def _insert(self, entries):
+        """Insert entries in batches, skipping the ones already there"""
+        entries = iter(entries)
+        while batch := list(islice(entries, TIMELINE_BATCH_SIZE)):
+            self.bulk_create(batch, ignore_conflicts=True)
+
+    def fan_out(self, post):
+        """Add a new post to the timeline of every follower"""
+        if sharding.shards() or self.is_high_follower(post.creator_id):
+            return
+        followers = Follow.objects.filter(
+            user_followed=post.creator_id).values_list(
+            "user_following", flat=True)
+        self._insert(
+            TimelineEntry(user_id=user_id, post_id=post.id,
+                creator_id=post.creator_id, created_at=post.created_at)
+            for user_id in followers.iterator(chunk_size=TIMELINE_BATCH_SIZE)
+        )
+
+    def backfill(self, follow):
+        """Add the latest posts of a new followed user to the timeline"""
+        if sharding.shards() or self.is_high_follower(
+                follow.user_followed_id):
+            return
+        posts = Post.objects.filter(creator=follow.user_followed_id).order_by(
+            "-created_at", "-id").values_list("id", "created_at")
+        self._insert(
+            TimelineEntry(user_id=follow.user_following_id, post_id=post_id,
+                creator_id=follow.user_followed_id, created_at=created_at)
+            for post_id, created_at in posts[:TIMELINE_BACKFILL]
+        )
+
+    def backfill_many(self, follows):
+        """
+        Backfill timelines for follows made without Follow.save(), reading
+        the latest posts of each followed user once.
+        """
+        if sharding.shards():
+            return
+        followed_ids = follows.order_by().values_list("user_followed",
+            flat=True).distinct()
+        for followed_id in followed_ids.iterator():
+            if self.is_high_follower(followed_id):
+                continue
+            posts = list(Post.objects.filter(creator=followed_id).order_by(
+                "-created_at", "-id").values_list("id", "created_at")[
+                :TIMELINE_BACKFILL])
+            followers = follows.filter(user_followed=followed_id).values_list(
+                "user_following", flat=True)
+            self._insert(
+                TimelineEntry(user_id=user_id, post_id=post_id,
+                    creator_id=followed_id, created_at=created_at)
+                for user_id in followers.iterator()
+                for post_id, created_at in posts
+            )
+
+    def trim(self, follow):
+        """Drop the posts of an unfollowed user from the timeline"""
+        self.filter(user=follow.user_following_id,
+            creator=follow.user_followed_id).delete()
+
+    def feed_sources(self, user):
+        """
+        Querysets merged into the following feed: the materialized timeline
+        plus the posts of each followed high follower account, read on
+        demand. One query per account seeks its own index range instead of
+        sorting the posts of all of them. Each one comes with the
+        (created_at, id) keys to paginate it.
+
+        On sharded databases every shard holding followed users reads their
+        posts instead, and the pages merge them by created_at.
+        """
+        if sharding.shards():
+            followed = Follow.objects.filter(user_following=user).values_list(
+                "user_followed", flat=True)
+            return [
+                (Post.objects.using(shard).filter(creator__in=user_ids),
+                    ("created_at", "id"))
+                for shard, user_ids in sharding.group_by_shard(followed,
+                    sharding.shard_for_user).items()
+            ]
+        timeline = Post.objects.filter(timeline_entries__user=user).annotate(
+            feed_at=F("timeline_entries__created_at"),
+            feed_id=F("timeline_entries__post_id"))
+        high_followers = User.objects.filter(
+            followers_list__user_following=user,
+            merged_on_read=True).values_list(
+            "id", flat=True)
+        return [(timeline, ("feed_at", "feed_id"))] + [
+            (Post.objects.filter(creator=user_id), ("created_at", "id"))
+            for user_id in high_followers
+        ]
+
+
+class TimelineEntry(models.Model):
+    """Posts delivered to the following feed of a user"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+        related_name="timeline")
+    post = models.ForeignKey(Post, on_delete=models.CASCADE,
+        related_name="timeline_entries")
+    # Copied from the post to read and trim timelines without joins
+    creator = models.ForeignKey(User, on_delete=models.CASCADE,
+        related_name="+")
+    created_at = models.DateTimeField()
+
+    objects = TimelineManager()
+
+    def __str__(self):
+        return f"Post n°{self.post_id} in {self.user_id}'s timeline."
+
+    class Meta:
+        """Each post shows once per timeline, read newest first"""
+        unique_together = ("user", "post")
+        indexes = [
+            models.Index(fields=["user", "-created_at", "-post"],
+                name="timeline_user_recent_idx"),
+            models.Index(fields=["user", "creator"],
+                name="timeline_user_creator_idx"),
+        ]
+
+
+class ShardBucket(models.Model):
+    """Shard holding the posts of the users of a bucket, see sharding"""
+    bucket = models.PositiveSmallIntegerField(primary_key=True)
+    shard = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f"Bucket {self.bucket} on {self.shard}."
+
+
+class JobManager(models.Manager):
+    """Queue of deferred work, run by the run_jobs command"""
+    def enqueue(self, name, payload, key=None, run_at=None):
+        """
+        Add a job, unless one with the same idempotency key is kept already.
+        Returns whether it was added.
+        """
+        defaults = {"name": name, "payload": payload,
+            "run_at": run_at or timezone.now()}
+        if key is None:
+            self.create(**defaults)
+            return True
+        return self.get_or_create(key=key, defaults=defaults)[1]
+
+    def enqueue_many(self, name, payloads):
+        """Add jobs without idempotency keys in one statement"""
+        now = timezone.now()
+        self.bulk_create([self.model(name=name, payload=payload, run_at=now)
+            for payload in payloads])
+
+
+class Job(models.Model):
+    """Deferred work, see network.jobs"""
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # Enqueuing a key again does nothing until the job is purged
+    key = models.CharField(max_length=200, null=True, unique=True)
+    status = models.CharField(max_length=10, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    # Claimed by a worker until then, others take it over if it dies
+    locked_by = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True)
+
+    objects = JobManager()
+
+    def __str__(self):
+        return f"{self.name} job n°{self.id} ({self.status})."
+
+    class Meta:
+        """Workers look for pending jobs that are due"""
+        indexes = [
+            models.Index(fields=["status", "run_at"], name="job_due_idx"),
+        ]
@@ -0,0 +1,189 @@
+import base64
+from datetime import datetime, timedelta, timezone
+
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import Http404
+
+
+POSTS_PER_PAGE = 10
+# Deepest page reachable through "?page=", deeper pages use cursors
+MAX_PAGE_NUMBER = 50
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Cursor directions
+NEXT = "n"
+PREVIOUS = "p"
+LAST = "l"
+
+
+def encode_cursor(direction, created_at=None, pk=None):
+    """Pack a direction and a (created_at, id) key into an opaque token"""
+    if created_at is None:
+        raw = direction
+    else:
+        micros = (created_at - EPOCH) // timedelta(microseconds=1)
+        raw = f"{direction}.{micros}.{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Unpack a token made by encode_cursor, None if it is not valid"""
+    if not token:
+        return None
+    try:
+        padding = "=" * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(token + padding).decode()
+        parts = raw.split(".")
+        if parts == [LAST]:
+            return LAST, None, None
+        direction, micros, pk = parts
+        if direction not in (NEXT, PREVIOUS):
+            return None
+        created_at = EPOCH + timedelta(microseconds=int(micros))
+        return direction, created_at, int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class CursorPage:
+    """A page of posts read with keyset pagination"""
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        # Cursor to jump to the oldest posts
+        self.last_cursor = encode_cursor(LAST) if next_cursor else None
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class KeysetPaginator:
+    """
+    Paginate newest first by (created_at, id) without COUNT or OFFSET, so
+    every page costs the same no matter how deep it is.
+
+    Several sources can be merged into one feed, each given as a queryset
+    or as a (queryset, keys) pair naming its created_at and id fields.
+    """
+    def __init__(self, *sources, per_page=POSTS_PER_PAGE):
+        self.sources = [
+            source if isinstance(source, tuple)
+            else (source, ("created_at", "id"))
+            for source in sources
+        ]
+        self.per_page = per_page
+
+    @staticmethod
+    def _after(keys, created_at, pk, lookup):
+        """
+        Filter rows strictly before ("lt") or after ("gt") a key. The
+        inclusive bound on created_at lets the database seek the index.
+        """
+        time_key, id_key = keys
+        return Q(**{f"{time_key}__{lookup}e": created_at}) & (
+            Q(**{f"{time_key}__{lookup}": created_at}) |
+            Q(**{f"{id_key}__{lookup}": pk}))
+
+    def queries(self, cursor, limit):
+        """Query of every source reading up to limit rows past the cursor"""
+        direction, created_at, pk = cursor or (NEXT, None, None)
+        newest_first = direction == NEXT
+        for queryset, keys in self.sources:
+            time_key, id_key = keys
+            if newest_first:
+                queryset = queryset.order_by(f"-{time_key}", f"-{id_key}")
+            else:
+                queryset = queryset.order_by(time_key, id_key)
+            if created_at is not None:
+                queryset = queryset.filter(self._after(keys, created_at, pk,
+                    "lt" if newest_first else "gt"))
+            yield queryset[:limit], keys
+
+    def _fetch(self, cursor, limit):
+        """
+        Read up to limit rows past the cursor from every source, keyed by
+        (created_at, id) and sorted in reading direction.
+        """
+        newest_first = cursor is None or cursor[0] == NEXT
+        rows = {}
+        for queryset, (time_key, id_key) in self.queries(cursor, limit):
+            for row in queryset:
+                rows[(getattr(row, time_key), getattr(row, id_key))] = row
+        return sorted(rows.items(), reverse=newest_first)[:limit]
+
+    def get_page(self, token):
+        cursor = decode_cursor(token)
+        size = self.per_page
+        rows = self._fetch(cursor, size + 1)
+        direction = cursor[0] if cursor else None
+
+        if direction in (PREVIOUS, LAST):
+            has_newer = len(rows) > size
+            has_older = direction == PREVIOUS
+            rows = rows[:size][::-1]
+        else:
+            has_newer = direction == NEXT
+            has_older = len(rows) > size
+            rows = rows[:size]
+
+        next_cursor = previous_cursor = None
+        if rows and has_older:
+            next_cursor = encode_cursor(NEXT, *rows[-1][0])
+        if rows and has_newer:
+            previous_cursor = encode_cursor(PREVIOUS, *rows[0][0])
+        return CursorPage([row for key, row in rows], next_cursor,
+            previous_cursor)
+
+
+def paginate_posts(request, posts):
+    """
+    Paginate posts with cursors, shallow "?page=" links still work through
+    the regular paginator and deeper ones are not found. Posts can be a
+    queryset or a list of sources for KeysetPaginator, which only serve the
+    first page by number.
+    """
+    page_number = request.GET.get("page")
+    if page_number and "cursor" not in request.GET:
+        try:
+            page_number = int(page_number)
+        except ValueError:
+            page_number = 1
+        if page_number > MAX_PAGE_NUMBER:
+            raise Http404(f"Pages past {MAX_PAGE_NUMBER} are read with "
+                "cursors")
+        if isinstance(posts, list):
+            if page_number > 1:
+                raise Http404("Merged feeds are read with cursors")
+            return KeysetPaginator(*posts).get_page(None)
+        paginator = Paginator(posts.order_by("-created_at", "-id"),
+            POSTS_PER_PAGE)
+        page = paginator.get_page(page_number)
+        # Deeper pages continue with cursors, the page links stop here
+        if page.number >= MAX_PAGE_NUMBER and page.has_next():
+            last_post = page[len(page) - 1]
+            page.next_cursor = encode_cursor(NEXT, last_post.created_at,
+                last_post.id)
+        if paginator.num_pages > MAX_PAGE_NUMBER:
+            page.last_cursor = encode_cursor(LAST)
+        return page
+
+    if isinstance(posts, list):
+        paginator = KeysetPaginator(*posts)
+    else:
+        paginator = KeysetPaginator(posts)
+    return paginator.get_page(request.GET.get("cursor"))
@@ -0,0 +1,93 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import sharding
+
+
+# Statements changing rows, WITH stands for the writes of LikeManager
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+class PrimaryPin:
+    """
+    Whether reads of the request being served must see its own writes. As
+    a query observer it sets itself once the request writes, see
+    ReplicaPinningMiddleware.
+    """
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+
+    def observe(self, elapsed, sql):
+        if not self.pinned and sql.lstrip()[:7].upper().startswith(
+                WRITE_STATEMENTS):
+            self.pinned = True
+
+
+# Pin of the request being served, None outside requests
+pinned_to_primary = ContextVar("pinned_to_primary", default=None)
+
+
+class ReplicaRouter:
+    """
+    Send reads to the NETWORK_DB_REPLICAS databases and writes to the
+    primary. Reads inside a transaction go to the primary, and so do the
+    rest of the reads of a request once it writes.
+    """
+    def db_for_read(self, model, **hints):
+        replicas = getattr(settings, "NETWORK_DB_REPLICAS", [])
+        pin = pinned_to_primary.get()
+        if not replicas or (pin and pin.pinned) or \
+                connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def is_sharded(model):
+    """Whether a model or an instance of it lives on the shards"""
+    return model._meta.app_label == "network" and \
+        model._meta.model_name in ("post", "like")
+
+
+class ShardRouter:
+    """
+    Place new posts on the shard of their creator and likes on the shard of
+    their post, see network.sharding. Related rows are read from the shard
+    of the row they come from, other queries pick their shard with using().
+    Every shard gets every table.
+    """
+    def _shard(self, model, instance):
+        if not sharding.shards() or not is_sharded(model) or \
+                instance is None or not is_sharded(instance):
+            return None
+        if not instance._state.adding:
+            return instance._state.db
+        if instance._meta.model_name == "post":
+            key, locate = instance.creator_id, sharding.shard_for_user
+        else:
+            key, locate = instance.post_id, sharding.shard_for_post
+        # e.g. a form validating a post before it has a creator
+        return None if key is None else locate(key)
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints.get("instance"))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in sharding.shards():
+            return True
+        return None
@@ -0,0 +1,127 @@
+import itertools
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# Users are split in buckets by id, and each bucket lives on one shard
+SHARD_BUCKETS = 256
+BUCKET_BITS = 8
+SEQUENCE_BITS = 14
+# Post ids count seconds from here, they stay below 2 ** 53 for JavaScript
+SHARD_EPOCH = 1704067200
+
+# Per process, starting anywhere so processes rarely draw the same ids
+_sequence = itertools.count(random.randrange(1 << SEQUENCE_BITS))
+
+
+def shards():
+    """Aliases of the shard databases, empty when nothing is sharded"""
+    return getattr(settings, "NETWORK_SHARDS", [])
+
+
+def bucket_of_user(user_id):
+    return user_id % SHARD_BUCKETS
+
+
+def bucket_of_post(post_id):
+    return (post_id >> SEQUENCE_BITS) % SHARD_BUCKETS
+
+
+def new_post_id(creator_id, created_at=None):
+    """
+    Id of a new post on a sharded database: seconds since SHARD_EPOCH, the
+    bucket of its creator and a sequence number. The bucket locates the
+    post without asking every shard. Posts older than SHARD_EPOCH count
+    from it, their ids would be negative.
+    """
+    seconds = max(int(created_at.timestamp() if created_at else time.time()),
+        SHARD_EPOCH)
+    sequence = next(_sequence) % (1 << SEQUENCE_BITS)
+    return ((seconds - SHARD_EPOCH) << (BUCKET_BITS + SEQUENCE_BITS) |
+        bucket_of_user(creator_id) << SEQUENCE_BITS | sequence)
+
+
+class ShardMap:
+    """
+    Shard of every bucket, stored by ShardBucket and read again every
+    NETWORK_SHARD_MAP_TTL seconds. Buckets start spread round robin over
+    the shards, rebalance_shards moves them.
+    """
+    def __init__(self):
+        self._buckets = None
+        self._shards = None
+        self._loaded_at = 0.0
+
+    def clear(self):
+        self._buckets = None
+
+    def load(self, aliases):
+        from .models import ShardBucket
+
+        stored = ShardBucket.objects.using(DEFAULT_DB_ALIAS)
+        if not stored.exists():
+            # Saved so adding a shard later moves nothing by itself
+            stored.bulk_create([
+                ShardBucket(bucket=bucket, shard=aliases[bucket % len(
+                    aliases)])
+                for bucket in range(SHARD_BUCKETS)
+            ], ignore_conflicts=True)
+        buckets = [aliases[bucket % len(aliases)]
+            for bucket in range(SHARD_BUCKETS)]
+        for bucket, shard in stored.values_list("bucket", "shard"):
+            if shard in aliases:
+                buckets[bucket] = shard
+        return buckets
+
+    def buckets(self):
+        aliases = tuple(shards())
+        ttl = getattr(settings, "NETWORK_SHARD_MAP_TTL", 5)
+        if self._buckets is None or self._shards != aliases or \
+                time.monotonic() - self._loaded_at > ttl:
+            self._buckets = self.load(aliases)
+            self._shards = aliases
+            self._loaded_at = time.monotonic()
+        return self._buckets
+
+
+shard_map = ShardMap()
+
+
+def shard_for_user(user_id):
+    """Database holding the posts of a user, None when nothing is sharded"""
+    if not shards():
+        return None
+    return shard_map.buckets()[bucket_of_user(user_id)]
+
+
+def shard_for_post(post_id):
+    """Database holding a post and its likes, None when nothing is sharded"""
+    if not shards():
+        return None
+    return shard_map.buckets()[bucket_of_post(post_id)]
+
+
+def group_by_shard(ids, locate):
+    """Split ids by the database locate(id) returns for them"""
+    groups = {}
+    for pk in ids:
+        groups.setdefault(locate(pk), []).append(pk)
+    return groups
+
+
+def add_database(alias, path):
+    """Register a SQLite database at runtime, for tests and benchmarks"""
+    configured = connections.configure_settings({
+        DEFAULT_DB_ALIAS: {},
+        alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": path},
+    })
+    connections.settings[alias] = configured[alias]
+
+
+def remove_database(alias):
+    connections[alias].close()
+    del connections[alias]
+    del connections.settings[alias]
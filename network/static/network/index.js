@@ -8,7 +8,22 @@ document.addEventListener('DOMContentLoaded', function() {
         element.addEventListener('click', (event) => likePost(event))
     });
 
-    
+    // Append older posts while scrolling
+    const postsTag = document.querySelector('#posts');
+    if (postsTag && postsTag.dataset.cursor) {
+        window.addEventListener('scroll', () => loadMorePosts(postsTag));
+    }
+
+    // Live like counts and new posts, only streamed under ASGI
+    if (postsTag && postsTag.dataset.live) {
+        listenToEvents(postsTag);
+        let scrollTimer = null;
+        window.addEventListener('scroll', () => {
+            clearTimeout(scrollTimer);
+            scrollTimer = setTimeout(() => listenToEvents(postsTag), 1000);
+        });
+    }
+
     // Check if user is in its own profile or not
     if (document.querySelector('title').innerHTML === 'Profile') {
         
@@ -24,36 +39,215 @@ document.addEventListener('DOMContentLoaded', function() {
         
 function update_follow(event) {
 
-    const csrftoken = getCookie('csrftoken');
     const button = event.target;
     const followersCounter = document.querySelector('#followersCount');
-    let counter = parseInt(followersCounter.innerHTML);
+    const userId = button.value;
+    const follow = button.innerHTML.trim() === 'Follow';
+
+    // Show the change now, the server answer confirms it
+    button.innerHTML = follow ? 'Unfollow' : 'Follow';
+    const rollback = () => button.innerHTML = follow ? 'Follow' : 'Unfollow';
+    queueOperation(`user-${userId}`, {
+        op: follow ? 'follow' : 'unfollow',
+        user: userId
+    }, result => {
+        const user = result.users[userId];
+        if (!user) {
+            rollback();
+            return;
+        }
+        console.log(`${user.following ? 'Following' : 'Unfollowing'} succesfully.`);
+        // Update following button and counter
+        button.innerHTML = user.following ? 'Unfollow' : 'Follow';
+        followersCounter.innerHTML = user.followersCount;
+        colorAnimation(followersCounter);
+    }, rollback);
+} 
+
+// Clicks waiting to be sent in one batch
+const pendingOperations = new Map();
+let flushTimer = null;
+
+// Send the waiting clicks before the page goes away
+window.addEventListener('pagehide', () => flushOperations(true));
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') {
+        flushOperations(true);
+    }
+});
+
+function queueOperation(key, operation, callback, rollback) {
+    // Later clicks on the same target replace earlier ones, a failure
+    // goes back to the state before the first
+    const earlier = pendingOperations.get(key);
+    pendingOperations.set(key, {
+        operation, callback,
+        rollback: earlier ? earlier.rollback : rollback
+    });
+    clearTimeout(flushTimer);
+    flushTimer = setTimeout(flushOperations, 300);
+}
 
-    fetch('/follow', {
+function flushOperations(leaving = false) {
+    clearTimeout(flushTimer);
+    if (pendingOperations.size === 0) {
+        return;
+    }
+    const queued = [...pendingOperations.values()];
+    pendingOperations.clear();
+    const csrftoken = getCookie('csrftoken');
+
+    fetch('/batch', {
         method: 'POST',
         headers: {'X-CSRFToken': csrftoken},
         body: JSON.stringify({
-            follow: button.innerHTML,
-            user_to_follow: button.value
+            operations: queued.map(item => item.operation)
         }),
-        mode: 'same-origin'
+        mode: 'same-origin',
+        // Outlives the page when it is closed or left
+        keepalive: leaving
     })
+    .then(response => {
+        if (!response.ok) {
+            throw new Error(`Batch failed with status ${response.status}`);
+        }
+        return response.json();
+    })
+    .then(result => queued.forEach(item => item.callback(result)))
+    .catch(error => {
+        console.error(error);
+        queued.forEach(item => item.rollback());
+    });
+}
+
+function loadMorePosts(postsTag) {
+    // Wait until the bottom of the page is close
+    const bottom = window.innerHeight + window.scrollY;
+    if (postsTag.dataset.loading || !postsTag.dataset.cursor ||
+        bottom < document.body.offsetHeight - 300) {
+        return;
+    }
+    postsTag.dataset.loading = 'true';
+    const params = new URLSearchParams({
+        feed: postsTag.dataset.feed,
+        cursor: postsTag.dataset.cursor
+    });
+
+    fetch(`/api/posts?${params}`, {mode: 'same-origin'})
     .then(response => response.json())
     .then(result => {
-        console.log(`${result.message} succesfully.`);
-        // Update following button and counter
+        result.posts.forEach(post => postsTag.append(createPostCard(post)));
+        postsTag.dataset.cursor = result.nextCursor || '';
 
-        if (result.message === 'Following') {
-            button.innerHTML = 'Unfollow';
-            followersCounter.innerHTML = counter + 1;
-            colorAnimation(followersCounter);
-        } else {
-            button.innerHTML = 'Follow';
-            followersCounter.innerHTML = counter - 1;
-            colorAnimation(followersCounter);
-        };
+        // Keep the pagination links after the last post shown
+        const nextTag = document.querySelector('#next');
+        if (nextTag && result.nextCursor) {
+            nextTag.setAttribute('href', `?cursor=${result.nextCursor}`);
+        } else if (nextTag) {
+            nextTag.style.display = 'none';
+            document.querySelector('#last').style.display = 'none';
+        }
+    })
+    .finally(() => delete postsTag.dataset.loading);
+}
+
+let eventSource = null;
+let eventParams = null;
+let newPosts = 0;
+// Same as NETWORK_EVENTS_MAX_POSTS
+const maxLivePosts = 50;
+
+function visiblePostIds(postsTag) {
+    // Cards on screen, or about to be
+    const margin = window.innerHeight;
+    return [...postsTag.querySelectorAll('.card')].filter(card => {
+        const box = card.getBoundingClientRect();
+        return box.bottom > -margin && box.top < window.innerHeight + margin;
+    }).slice(0, maxLivePosts).map(card => card.dataset.postid);
+}
+
+function listenToEvents(postsTag) {
+    // Reconnect when other posts are on screen
+    const params = new URLSearchParams({
+        feed: postsTag.dataset.feed,
+        posts: visiblePostIds(postsTag).join(',')
+    }).toString();
+    if (params === eventParams) {
+        return;
+    }
+    if (eventSource) {
+        eventSource.close();
+    }
+    eventParams = params;
+    eventSource = new EventSource(`/events?${params}`);
+
+    eventSource.addEventListener('like', (event) => {
+        const data = JSON.parse(event.data);
+        const likesCounter = document.querySelector(`#like-${data.id}`);
+        if (likesCounter && likesCounter.innerHTML.trim() !== '❤️' + data.likesCount) {
+            likesCounter.innerHTML = '❤️' + data.likesCount;
+            colorAnimation(likesCounter);
+        }
     });
-} 
+    eventSource.addEventListener('post', () => {
+        newPosts++;
+        let noticeTag = document.querySelector('#new-posts');
+        if (!noticeTag) {
+            noticeTag = document.createElement('a');
+            noticeTag.id = 'new-posts';
+            noticeTag.className = 'btn btn-block mb-3';
+            noticeTag.setAttribute('href', '?');
+            postsTag.before(noticeTag);
+        }
+        noticeTag.innerHTML = newPosts === 1 ? '1 new post' : `${newPosts} new posts`;
+    });
+}
+
+function createPostCard(post) {
+    // Same markup as post_card.html, text is never parsed as HTML
+    const card = document.createElement('div');
+    card.className = 'card mb-3 border border-dark rounded';
+    card.dataset.postid = post.id;
+    card.innerHTML = `
+        <div class="card-header pt-2">
+            <div class="row">
+                <div class="col">
+                    <a href="/profile/${post.creator.id}"></a>
+                    <small></small>
+                </div>
+            </div>
+        </div>
+        <div class="card-body" id="post-${post.id}">
+            <p id="content-${post.id}"></p>
+            <div id="form-${post.id}"></div>
+        </div>
+        <div class="card-body like-container">
+            <span class="mr-1" id="like-${post.id}">❤️${post.likesCount}</span>
+        </div>`;
+    card.querySelector('.col a').textContent = post.creator.username;
+    card.querySelector('small').textContent = new Date(post.createdAt).toLocaleString();
+    card.querySelector(`#content-${post.id}`).textContent = post.content;
+
+    // Controls of the current user
+    if (post.editable) {
+        const editTag = document.createElement('div');
+        editTag.className = 'col text-right';
+        editTag.innerHTML = `<a class="editPost" id="edit-${post.id}" href="#">Edit</a>`;
+        editTag.firstChild.addEventListener('click', (event) => editPost(event));
+        card.querySelector('.row').append(editTag);
+    }
+    if (post.liked !== null) {
+        const action = post.liked ? 'Unlike' : 'Like';
+        const icon = post.liked ? 'dislike' : 'like';
+        const likeContainer = card.querySelector('.like-container');
+        likeContainer.insertAdjacentHTML('beforeend',
+            `<img class="like" src="/static/network/${icon}.svg" alt="${action}">` +
+            `<span class="ml-auto position-relative">${action}</span>`);
+        likeContainer.querySelector('.like').addEventListener('click',
+            (event) => likePost(event));
+    }
+    return card;
+}
 
 function editPost(event) {
     // Get tags and content
@@ -122,29 +316,38 @@ function modifyPostContent(newContent, contentTag, postId, formTag, formElement)
 function likePost(event) {
     const postId = event.target.parentNode.parentNode.dataset.postid;
     const likesCounter = document.querySelector(`#like-${postId}`)
-    const csrftoken = getCookie('csrftoken');
-    
-    fetch(`/like_post/${postId}`, {
-        method: 'POST',
-        headers: {'X-CSRFToken': csrftoken},
-        mode: 'same-origin'
-    })
-    .then(response => response.json())
-    .then(result => {
-        console.log(`Post ${result.message} succesfully.`);
-        likesCounter.innerHTML = '❤️' + result.likesCount;
-        colorAnimation(likesCounter);
+    const like = event.target.getAttribute('alt') === 'Like';
 
-        if (result.message === 'liked') {
-            event.target.setAttribute('src', "static/network/dislike.svg");
-            event.target.setAttribute('alt', "Unlike");
-            event.target.parentNode.children[2].innerHTML = 'Unlike';
-        } else {
-            event.target.setAttribute('src', "static/network/like.svg");
-            event.target.setAttribute('alt', "Like");
-            event.target.parentNode.children[2].innerHTML = 'Like';
+    // Show the change now, the server answer confirms it
+    setLikeIcon(event.target, like);
+    const rollback = () => setLikeIcon(event.target, !like);
+    queueOperation(`post-${postId}`, {
+        op: like ? 'like' : 'unlike',
+        post: postId
+    }, result => {
+        // Deleted posts are missing from the answer
+        const post = result.posts[postId];
+        if (!post) {
+            rollback();
+            return;
         }
-    })
+        console.log(`Post ${post.liked ? 'liked' : 'unliked'} succesfully.`);
+        likesCounter.innerHTML = '❤️' + post.likesCount;
+        colorAnimation(likesCounter);
+        setLikeIcon(event.target, post.liked);
+    }, rollback);
+}
+
+function setLikeIcon(icon, liked) {
+    if (liked) {
+        icon.setAttribute('src', "/static/network/dislike.svg");
+        icon.setAttribute('alt', "Unlike");
+        icon.parentNode.children[2].innerHTML = 'Unlike';
+    } else {
+        icon.setAttribute('src', "/static/network/like.svg");
+        icon.setAttribute('alt', "Like");
+        icon.parentNode.children[2].innerHTML = 'Like';
+    }
 }
 
 function getCookie(name) {
@@ -0,0 +1,12 @@
+from django import template
+
+from ..cards import render_cards
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def post_cards(context, posts):
+    """Render a page of posts from the card cache for the current user"""
+    return render_cards(posts, context["user"])
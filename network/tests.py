@@ -1,13 +1,36 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import Mock, call, patch
+
+from asgiref.sync import sync_to_async
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections
 from django.db.models import Max
-from django.test import Client, TestCase
+from django.http import HttpResponse
+from django.test import AsyncClient, Client, RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.webdriver import WebDriver
+from selenium.webdriver.support.ui import WebDriverWait
 
-from .models import User, Post, Follow, Like
+from . import cards, events, jobs, metrics, routers, sharding
+from .backends.sqlite3 import base as sqlite3
+from .management.commands.rebalance_shards import (
+    Command as RebalanceCommand)
+from .middleware import ReplicaPinningMiddleware
+from .models import User, Post, Follow, Like, TimelineEntry, Job
+from .timing import RequestTiming, TimedTemplate, current_timing
 
 class CommonSetUp:
     """Create Post instances for testing"""
@@ -64,6 +87,64 @@ class NetworkBackTestCase(CommonSetUp, TestCase):
         with self.assertRaises(IntegrityError):
             Like.objects.create(user=self.user1, post=self.p1)
 
+    def test_post_likes_count(self):
+        self.p1.refresh_from_db()
+        self.assertEqual(self.p1.likes_count, 2)
+
+        # A second copy of the like deleted again leaves the counter alone
+        like = Like.objects.get(user=self.user1, post=self.p1)
+        stale = Like.objects.get(pk=like.pk)
+        like.delete()
+        stale.delete()
+        self.p1.refresh_from_db()
+        self.assertEqual(self.p1.likes_count, 1)
+
+        # Liking through the endpoint returns the stored counter
+        c = Client()
+        c.force_login(self.user3)
+        response = c.post(reverse("network:like_post", args=[self.p1.id]))
+        self.assertEqual(response.json()["likesCount"], 2)
+        response = c.post(reverse("network:like_post", args=[self.p1.id]))
+        self.assertEqual(response.json()["likesCount"], 1)
+
+    def test_reconcile_counters(self):
+        Post.objects.update(likes_count=7)
+        out = StringIO()
+        call_command("reconcile_counters", batch_size=2, stdout=out)
+        self.assertIn("Posts likes_count fixed: 3", out.getvalue())
+        self.assertEqual(list(Post.objects.order_by("id").values_list(
+            "likes_count", flat=True)), [2, 0, 1])
+
+    def test_seed_network(self):
+        def seed():
+            call_command("seed_network", "--until=2024-01-01", users=30,
+                posts=200, follows=150, likes=600, seed=7, batch_size=50,
+                stdout=StringIO())
+            first = User.objects.filter(username__startswith="seed").order_by(
+                "id")[0].id
+            return [(creator - first, created_at, likes)
+                for creator, created_at, likes in Post.objects.filter(
+                id__gt=3).order_by("id").values_list("creator", "created_at",
+                "likes_count")]
+
+        posts = seed()
+        self.assertEqual(User.objects.count(), 33)
+        self.assertEqual(len(posts), 200)
+        # Popular users get more followers and counters are rebuilt
+        followers = list(User.objects.order_by("-followers_count").values_list(
+            "followers_count", flat=True))
+        self.assertGreater(followers[0], 3 * followers[15])
+        self.assertEqual(sum(followers), Follow.objects.count())
+        self.assertEqual(sum(count for _, _, count in posts),
+            Like.objects.filter(post__id__gt=3).count())
+        self.assertTrue(TimelineEntry.objects.filter(
+            user__username__startswith="seed").exists())
+
+        # The same seed builds the same dataset
+        Post.objects.filter(id__gt=3).delete()
+        User.objects.filter(username__startswith="seed").delete()
+        self.assertEqual(seed(), posts)
+
     def test_follow(self):
         following = Follow.objects.filter(user_following=2)
         followed = Follow.objects.all().values_list("user_followed", flat=True)
@@ -73,6 +154,42 @@ class NetworkBackTestCase(CommonSetUp, TestCase):
         self.assertIn(1, followed)
         self.assertIn(3, followed)
 
+    def test_follow_counts(self):
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.following_count, 2)
+        self.assertEqual(self.user2.followers_count, 0)
+
+        # Concurrent unfollows move the counters once
+        follow = Follow.objects.get(user_following=self.user2,
+            user_followed=self.user1)
+        stale = Follow.objects.get(pk=follow.pk)
+        follow.delete()
+        stale.delete()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.following_count, 1)
+        self.assertEqual(User.objects.get(pk=self.user1.pk).followers_count, 0)
+        Follow.objects.create(user_following=self.user2,
+            user_followed=self.user1)
+
+        # Following through the endpoint returns the stored counter
+        c = Client()
+        c.force_login(self.user3)
+        response = c.post(reverse("network:follow"), {"follow": "Follow",
+            "user_to_follow": self.user1.id}, content_type="application/json")
+        self.assertEqual(response.json()["followersCount"], 2)
+        response = c.post(reverse("network:follow"), {"follow": "Unfollow",
+            "user_to_follow": self.user1.id}, content_type="application/json")
+        self.assertEqual(response.json()["followersCount"], 1)
+
+        # Drifted counters are rebuilt
+        User.objects.update(followers_count=5, following_count=0)
+        out = StringIO()
+        call_command("reconcile_counters", stdout=out)
+        self.assertIn("Users followers_count fixed: 3", out.getvalue())
+        self.assertIn("Users following_count fixed: 1", out.getvalue())
+        self.assertEqual(list(User.objects.order_by("id").values_list(
+            "followers_count", "following_count")), [(1, 0), (0, 2), (1, 0)])
+
     def test_follow_duplication(self):
         with self.assertRaises(IntegrityError):
             Follow.objects.create(user_following=self.user2,
@@ -84,6 +201,66 @@ class NetworkBackTestCase(CommonSetUp, TestCase):
                 user_followed=self.user1)
             f3.follow_is_valid()
 
+    def test_timeline_fan_out(self):
+        # Follows backfill the timeline, new posts are fanned out
+        timeline = TimelineEntry.objects.filter(user=self.user2)
+        self.assertEqual(set(timeline.values_list("post", flat=True)),
+            {self.p1.id, self.p3.id})
+        post = Post.objects.create(content="jkl", creator=self.user3)
+        self.assertTrue(timeline.filter(post=post).exists())
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user1).exists())
+
+        # Unfollowing trims the timeline
+        Follow.objects.get(user_following=self.user2,
+            user_followed=self.user1).delete()
+        self.assertEqual(list(timeline.values_list("post", flat=True)),
+            [post.id])
+
+    @patch("network.models.FANOUT_FOLLOWER_LIMIT", 1)
+    def test_timeline_high_follower(self):
+        # High follower posts are merged when the feed is read
+        TimelineEntry.objects.pause_fan_out(User.objects.all())
+        post = Post.objects.create(content="jkl", creator=self.user1)
+        self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+
+        c = Client()
+        c.force_login(self.user2)
+        response = c.get(reverse("network:following"))
+        self.assertEqual([p.id for p in response.context['posts']],
+            [post.id, self.p3.id, self.p1.id])
+
+    @patch("network.models.FANOUT_FOLLOWER_LIMIT", 3)
+    @patch("network.models.FANOUT_RESUME_LIMIT", 2)
+    def test_timeline_resume_fan_out(self):
+        user4 = User.objects.create_user(username="dan", password="1234")
+        Follow.objects.create(user_following=self.user3,
+            user_followed=self.user1)
+        Follow.objects.create(user_following=user4, user_followed=self.user1)
+        self.assertTrue(User.objects.get(pk=self.user1.pk).merged_on_read)
+        post = Post.objects.create(content="jkl", creator=self.user1)
+        timeline = TimelineEntry.objects.filter(user=self.user2,
+            creator=self.user1)
+        self.assertFalse(timeline.filter(post=post).exists())
+
+        # Dropping just below the limit switches nothing
+        Follow.objects.get(user_following=user4,
+            user_followed=self.user1).delete()
+        self.assertTrue(User.objects.get(pk=self.user1.pk).merged_on_read)
+
+        # Below the resume limit a job delivers the posts merged until then
+        c = Client()
+        c.force_login(self.user3)
+        c.post(reverse("network:batch"), {"operations": [
+            {"op": "unfollow", "user": self.user1.id}]},
+            content_type="application/json")
+        self.assertFalse(User.objects.get(pk=self.user1.pk).merged_on_read)
+        self.assertFalse(timeline.filter(post=post).exists())
+        self.assertEqual(Job.objects.filter(name="restore_fan_out",
+            payload={"followed": self.user1.id}).count(), 1)
+        call_command("run_jobs", once=True, stdout=StringIO())
+        self.assertEqual(set(timeline.values_list("post", flat=True)),
+            set(self.user1.posts.values_list("id", flat=True)))
+
     # Test Web Pages
     def test_index_page(self):
         c = Client()
@@ -145,6 +322,989 @@ class NetworkBackTestCase(CommonSetUp, TestCase):
         c.force_login(self.user3)
         response = c.get('/profile/2')
         self.assertFalse(response.context['profile_user'].is_following)
+        response = c.get('/profile/1')
+        self.assertEqual(response.context['profile_user'].followers_count, 1)
+
+        # Logged user 2
+        c.force_login(self.user2)
+        response = c.get('/profile/1')
+        self.assertTrue(response.context['profile_user'].is_following)
+
+        # Missing users
+        self.assertEqual(c.get('/profile/99').status_code, 404)
+
+    def test_cursor_pagination(self):
+        for i in range(22):
+            Post.objects.create(content=f"{i}", creator=self.user1)
+        c = Client()
+
+        # First page has no previous cursor
+        response = c.get("/")
+        posts = response.context['posts']
+        self.assertEqual(len(posts), 10)
+        self.assertEqual(posts[0].content, "21")
+        self.assertIsNone(posts.previous_cursor)
+
+        # Walk every page with next cursors
+        seen = [post.id for post in posts]
+        while posts.has_next():
+            response = c.get("/", {"cursor": posts.next_cursor})
+            posts = response.context['posts']
+            seen += [post.id for post in posts]
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+        self.assertEqual(posts[len(posts) - 1], self.p1)
+
+        # Go back with the previous cursor
+        response = c.get("/", {"cursor": posts.previous_cursor})
+        self.assertEqual([post.id for post in response.context['posts']],
+            seen[10:20])
+
+        # Last page shows the oldest posts
+        response = c.get("/", {"cursor": response.context['posts'].last_cursor})
+        posts = response.context['posts']
+        self.assertEqual([post.id for post in posts], seen[15:])
+        self.assertFalse(posts.has_next())
+
+    def test_feed_query_count(self):
+        c = Client()
+        c.force_login(self.user2)
+        pages = {
+            "/": 4,
+            "/profile/1": 5,
+            reverse("network:following"): 5,
+        }
+        for path, queries in pages.items():
+            # Session, user, profile header, the page and its liked posts
+            with self.assertNumQueries(queries):
+                response = c.get(path)
+            posts = response.context['posts']
+            self.assertTrue(all(post.liked for post in posts
+                if post.id in (self.p1.id, self.p3.id)))
+
+        # A full page takes the same queries
+        for i in range(15):
+            post = Post.objects.create(content=f"{i}", creator=self.user1)
+            Like.objects.create(user=self.user2, post=post)
+        for path, queries in pages.items():
+            with self.assertNumQueries(queries):
+                response = c.get(path)
+            self.assertEqual(len(response.context['posts']), 10)
+
+        # Liked posts only cover the current page
+        response = c.get("/")
+        self.assertEqual(response.context['liked_posts'],
+            {post.id for post in response.context['posts']})
+
+    def test_server_timing(self):
+        # Disabled by default
+        response = Client().get("/")
+        self.assertNotIn("Server-Timing", response.headers)
+
+        with self.settings(NETWORK_SERVER_TIMING=True, NETWORK_SLOW_QUERY_MS=0):
+            c = Client()
+            c.force_login(self.user1)
+            with self.assertLogs("network.sql", "WARNING") as logs:
+                response = c.get("/profile/1")
+        timing = response.headers["Server-Timing"]
+        self.assertIn('db;dur=', timing)
+        self.assertIn('desc="5 queries"', timing)
+        self.assertIn("view;dur=", timing)
+        self.assertIn("tpl;dur=", timing)
+        self.assertIn("Slow query in network:profile", logs.output[0])
+
+        # Nested card renders are part of the page render
+        durations = {name: float(duration) for name, duration in
+            re.findall(r"(\w+);dur=([-\d.]+)", timing)}
+        self.assertGreaterEqual(durations["view"], 0)
+        self.assertLessEqual(durations["tpl"], durations["total"])
+        inner = TimedTemplate(Mock(render=lambda context, request:
+            time.sleep(0.05)))
+        outer = TimedTemplate(Mock(render=lambda context, request:
+            inner.render()))
+        request_timing = RequestTiming()
+        token = current_timing.set(request_timing)
+        try:
+            outer.render()
+        finally:
+            current_timing.reset(token)
+        self.assertLess(request_timing.template_time, 0.09)
+
+    async def test_server_timing_asgi(self):
+        # The ORM runs in another thread than the middleware under ASGI
+        with self.settings(NETWORK_SERVER_TIMING=True, NETWORK_SLOW_QUERY_MS=0):
+            with self.assertLogs("network.sql", "WARNING"):
+                response = await AsyncClient().get("/profile/1")
+        self.assertIn('desc="2 queries"', response.headers["Server-Timing"])
+
+    async def test_metrics_asgi(self):
+        def queries_sum():
+            for line in metrics.registry.render().splitlines():
+                if line.startswith('network_db_queries_per_request_sum'
+                        '{view="profile"}'):
+                    return float(line.split()[-1])
+            return 0
+
+        before = await sync_to_async(queries_sum)()
+        await AsyncClient().get("/profile/1")
+        self.assertEqual(await sync_to_async(queries_sum)() - before, 2)
+
+    def test_metrics(self):
+        c = Client()
+        c.force_login(self.user2)
+        c.post(reverse("network:like_post", args=[self.p2.id]))
+        c.post(reverse("network:index"), {"content": "testing"})
+        c.get("/profile/1")
+
+        # Only staff users or the token bearer read the metrics
+        self.assertEqual(c.get(reverse("network:metrics")).status_code, 403)
+        with self.settings(NETWORK_METRICS_TOKEN="secret"):
+            response = Client().get(reverse("network:metrics"),
+                HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Client().get(reverse("network:metrics"),
+                HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        User.objects.filter(pk=self.user2.pk).update(is_staff=True)
+        c.generic("BREW", "/")
+
+        response = c.get(reverse("network:metrics"))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('network_requests_total{method="other",', text)
+        self.assertIn('network_requests_total{method="GET",status="200",'
+            'view="profile"}', text)
+        self.assertIn('network_request_duration_seconds_bucket{view="like_post",'
+            'le="+Inf"}', text)
+        self.assertIn('network_db_queries_per_request_count{view="index"}',
+            text)
+        self.assertIn('network_likes_toggled_total{action="liked"}', text)
+        self.assertIn("network_posts_created_total ", text)
+
+    def test_metrics_processes(self):
+        registry = metrics.Registry()
+        counter = registry.counter("test_total", "Test counter")
+        counter.inc(view="a")
+        thread = threading.Thread(target=counter.inc, kwargs={"view": "a"})
+        thread.start()
+        thread.join()
+        self.assertIn('test_total{view="a"} 2', registry.render())
+
+        # Finished threads are folded into the totals
+        for i in range(10):
+            thread = threading.Thread(target=counter.inc,
+                kwargs={"view": 'a "b"'})
+            thread.start()
+            thread.join()
+        self.assertIn('test_total{view="a \\"b\\""} 10', registry.render())
+        self.assertEqual(len(registry._shards), 1)
+
+        # Other processes totals are read from the shared directory
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "metrics-1.json"), "w") as dump:
+                json.dump([[["test_total", [["view", "a"]]], [5]]], dump)
+            with self.settings(NETWORK_METRICS_DIR=directory):
+                self.assertIn('test_total{view="a"} 7', registry.render())
+
+    def test_post_cards(self):
+        c = Client()
+        c.force_login(self.user1)
+        c.get("/")
+        cache = cards.card_cache()
+        self.p1.refresh_from_db()
+        self.assertIsNotNone(cache.get(cards.card_key(self.p1)))
+
+        # Viewer controls are not part of the cached card
+        card = cache.get(cards.card_key(self.p1))
+        self.assertIn(cards.EDIT_SLOT, card)
+        self.assertNotIn("editPost", card)
+        response = c.get("/")
+        self.assertContains(response, f'id="edit-{self.p1.id}"')
+        self.assertNotContains(response, f'id="edit-{self.p2.id}"')
+        self.assertContains(response, 'alt="Unlike"', count=1)
+        response = Client().get("/")
+        self.assertNotContains(response, "editPost")
+        self.assertNotContains(response, 'class="like"')
+
+        # Likes and edits bump the version and render a new card
+        c.post(reverse("network:like_post", args=[self.p2.id]))
+        self.p2.refresh_from_db()
+        self.assertEqual(self.p2.version, 2)
+        c.put(reverse("network:edit_post", args=[self.p2.id]),
+            json.dumps({"content": "edited"}))
+        self.p2.refresh_from_db()
+        self.assertEqual(self.p2.version, 3)
+        response = c.get("/")
+        self.assertContains(response, "edited")
+        self.assertContains(response, "❤️1")
+        self.assertContains(response, 'alt="Unlike"', count=2)
+
+    def test_post_cards_file_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(CACHES={"post_cards": {
+                    "BACKEND": "django.core.cache.backends.filebased."
+                    "FileBasedCache", "LOCATION": directory}}):
+                response = Client().get("/")
+                self.assertContains(response, "ghi")
+                self.assertEqual(len(os.listdir(directory)), 3)
+
+    def test_conditional_get(self):
+        c = Client()
+        c.force_login(self.user2)
+        response = c.get("/")
+        etag = response.headers["ETag"]
+        self.assertIn("private", response.headers["Cache-Control"])
+
+        # Unchanged pages are not rendered again
+        with self.assertTemplateNotUsed("network/index.html"):
+            response = c.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        # Likes change the page
+        c.post(reverse("network:like_post", args=[self.p2.id]))
+        response = c.get("/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Follows change the profile header and the viewer's state
+        profile = reverse("network:profile", args=[self.user3.id])
+        response = c.get(profile)
+        etag = response.headers["ETag"]
+        c.post(reverse("network:follow"), {"follow": "Unfollow",
+            "user_to_follow": self.user3.id}, content_type="application/json")
+        response = c.get(profile, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        response = c.get(profile, HTTP_IF_NONE_MATCH=response.headers["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        # Anonymous pages can be kept by shared caches
+        response = Client().get("/")
+        self.assertIn("public", response.headers["Cache-Control"])
+        self.assertIn("max-age=30", response.headers["Cache-Control"])
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_api_posts(self):
+        posts = [Post.objects.create(content=f"{i}", creator=self.user3)
+            for i in range(12)]
+        c = Client()
+        c.force_login(self.user1)
+        url = reverse("network:api_posts")
+
+        # Session, user, the page and its liked posts
+        with self.assertNumQueries(4):
+            response = c.get(url)
+        data = response.json()
+        self.assertEqual(len(data["posts"]), 10)
+        self.assertEqual(data["posts"][0]["content"], "11")
+        self.assertEqual(data["posts"][0]["creator"]["username"], "carlos")
+        response = c.get(url, {"cursor": data["nextCursor"]})
+        data = response.json()
+        self.assertEqual([post["id"] for post in data["posts"]],
+            [posts[1].id, posts[0].id, self.p3.id, self.p2.id, self.p1.id])
+        self.assertIsNone(data["nextCursor"])
+        first = data["posts"][-1]
+        self.assertEqual(first["id"], self.p1.id)
+        self.assertEqual(first["likesCount"], 2)
+        self.assertTrue(first["liked"])
+        self.assertTrue(first["editable"])
+
+        # User and following feeds
+        response = c.get(url, {"feed": f"user:{self.user2.id}"})
+        self.assertEqual([post["id"] for post in response.json()["posts"]],
+            [self.p2.id])
+        c.force_login(self.user2)
+        response = c.get(url, {"feed": "following"})
+        self.assertEqual(len(response.json()["posts"]), 10)
+
+        # Anonymous users get no like state nor the following feed
+        c = Client()
+        response = c.get(url, {"feed": f"user:{self.user1.id}"})
+        self.assertIsNone(response.json()["posts"][0]["liked"])
+        self.assertEqual(c.get(url, {"feed": "following"}).status_code, 401)
+        self.assertEqual(c.get(url, {"feed": "user:abc"}).status_code, 400)
+
+    async def test_events(self):
+        response = await AsyncClient().get(reverse("network:events"),
+            {"feed": f"user:{self.user1.id}", "posts": f"{self.p1.id}"})
+        self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b"retry: 5000\n\n")
+
+        # Only events about the page and the feed are sent
+        bus = events.get_bus()
+        bus.publish("like", {"id": self.p2.id, "likesCount": 1})
+        bus.publish("post", {"id": 10, "creator": self.user2.id})
+        bus.publish("like", {"id": self.p1.id, "likesCount": 3})
+        bus.publish("post", {"id": 11, "creator": self.user1.id})
+        self.assertEqual(await anext(stream), b'event: like\n'
+            b'data: {"id": %d, "likesCount": 3}\n\n' % self.p1.id)
+        self.assertEqual(await anext(stream), b'event: post\n'
+            b'data: {"id": 11, "creator": %d}\n\n' % self.user1.id)
+        await stream.aclose()
+
+        response = await AsyncClient().get(reverse("network:events"),
+            {"feed": "following"})
+        self.assertEqual(response.status_code, 401)
+        response = await AsyncClient().get(reverse("network:events"),
+            {"posts": ",".join(map(str, range(1, 52)))})
+        self.assertEqual(response.status_code, 400)
+
+        # Pages only open the stream under ASGI
+        response = await AsyncClient().get(reverse("network:index"))
+        self.assertContains(response, 'data-live="true"')
+
+    def test_events_wsgi(self):
+        # WSGI would hold a worker for the whole stream, browsers stop on 204
+        c = Client()
+        self.assertEqual(c.get(reverse("network:events")).status_code, 204)
+        self.assertNotContains(c.get(reverse("network:index")), "data-live")
+
+    def test_events_published(self):
+        c = Client()
+        c.force_login(self.user2)
+        with patch.object(events.get_bus(), "publish") as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                c.post(reverse("network:like_post", args=[self.p2.id]))
+                c.post(reverse("network:index"), {"content": "live"})
+        post = Post.objects.get(content="live")
+        self.assertEqual(publish.call_args_list, [
+            call("like", {"id": self.p2.id, "likesCount": 1}),
+            call("post", {"id": post.id, "creator": self.user2.id}),
+        ])
+
+    async def test_async_views(self):
+        c = AsyncClient()
+        await c.aforce_login(self.user2)
+        with self.settings(ROOT_URLCONF="project4.async_urls"):
+            response = await c.post(reverse("network:like_post",
+                args=[self.p2.id]))
+            self.assertEqual(response.json(), {"message": "liked",
+                "likesCount": 1})
+            response = await c.post(reverse("network:like_post",
+                args=[self.p1.id]))
+            self.assertEqual(response.json(), {"message": "unliked",
+                "likesCount": 1})
+
+            response = await c.post(reverse("network:follow"), {
+                "follow": "Unfollow", "user_to_follow": self.user1.id},
+                content_type="application/json")
+            self.assertEqual(response.json(), {"message": "Unfollowing",
+                "followersCount": 0})
+
+            response = await c.put(reverse("network:edit_post",
+                args=[self.p2.id]), {"content": "async"},
+                content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            post = await Post.objects.aget(pk=self.p2.id)
+            self.assertEqual(post.content, "async")
+            self.assertEqual(post.version, 3)
+
+            # Anonymous users are sent to log in
+            response = await AsyncClient().post(reverse("network:like_post",
+                args=[self.p2.id]))
+            self.assertEqual(response.status_code, 302)
+
+    def test_like_idempotent(self):
+        c = Client()
+        c.force_login(self.user3)
+        url = reverse("network:like_post", args=[self.p1.id])
+
+        # Retried likes and unlikes change nothing
+        for i in range(2):
+            response = c.put(url)
+            self.assertEqual(response.json(), {"message": "liked",
+                "likesCount": 3})
+        self.assertEqual(Like.objects.filter(post=self.p1).count(), 3)
+        for i in range(2):
+            response = c.delete(url)
+            self.assertEqual(response.json(), {"message": "unliked",
+                "likesCount": 2})
+        self.p1.refresh_from_db()
+        self.assertEqual(self.p1.likes_count, 2)
+        self.assertEqual(self.p1.version, 5)
+
+        # Session, user and one write plus the counter in a savepoint
+        with self.assertNumQueries(6):
+            c.put(url)
+        self.assertEqual(Like.objects.unlike(self.user3.id, self.p1.id),
+            (2, True))
+        self.assertEqual(Like.objects.toggle(self.user3.id, self.p1.id),
+            (3, True))
+        self.assertEqual(Like.objects.toggle(self.user3.id, self.p1.id),
+            (2, False))
+
+        # Missing posts
+        self.assertIsNone(Like.objects.like(self.user3.id, 999))
+        response = c.put(reverse("network:like_post", args=[999]))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Like.objects.filter(post=999).exists())
+
+        # A post deleted between the like and the unlike of a toggle
+        Like.objects.like(self.user3.id, self.p3.id)
+        with patch.object(Like.objects, "unlike", return_value=None):
+            response = c.post(reverse("network:like_post",
+                args=[self.p3.id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_batch(self):
+        c = Client()
+        c.force_login(self.user2)
+        response = c.post(reverse("network:batch"), {"operations": [
+            {"op": "like", "post": self.p2.id},
+            {"op": "unlike", "post": self.p1.id},
+            {"op": "like", "post": self.p3.id},
+            {"op": "unlike", "post": self.p2.id},
+            {"op": "like", "post": self.p2.id},
+            {"op": "unfollow", "user": self.user1.id},
+            {"op": "follow", "user": self.user2.id},
+            {"op": "unfollow", "user": self.user3.id},
+            {"op": "follow", "user": self.user3.id},
+        ]}, content_type="application/json")
+        data = response.json()
+        # Later operations on the same target win
+        self.assertEqual(data["posts"], {
+            str(self.p1.id): {"likesCount": 1, "liked": False},
+            str(self.p2.id): {"likesCount": 1, "liked": True},
+            str(self.p3.id): {"likesCount": 1, "liked": True},
+        })
+        self.assertEqual(data["users"], {
+            str(self.user1.id): {"followersCount": 0, "following": False},
+            str(self.user2.id): {"followersCount": 0, "following": False},
+            str(self.user3.id): {"followersCount": 1, "following": True},
+        })
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.following_count, 1)
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user2,
+            creator=self.user1).exists())
+        self.p2.refresh_from_db()
+        self.assertEqual(self.p2.version, 2)
+
+        # Counters move by the rows written, without counting them again
+        Post.objects.filter(pk=self.p1.pk).update(likes_count=10)
+        with CaptureQueriesContext(connection) as queries:
+            c.post(reverse("network:batch"), {"operations": [
+                {"op": "like", "post": self.p1.id},
+                {"op": "like", "post": self.p3.id}]},
+                content_type="application/json")
+        self.assertFalse([query for query in queries
+            if "COUNT(" in query["sql"].upper()])
+        self.assertEqual(Post.objects.get(pk=self.p1.pk).likes_count, 11)
+        self.assertEqual(Post.objects.get(pk=self.p3.pk).likes_count, 1)
+
+        # Follows add the followed user's posts to the timeline
+        response = c.post(reverse("network:batch"), {"operations": [
+            {"op": "follow", "user": self.user1.id}]},
+            content_type="application/json")
+        self.assertEqual(TimelineEntry.objects.filter(user=self.user2,
+            creator=self.user1).count(), 2)
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.following_count, 2)
+
+        response = c.post(reverse("network:batch"), {"operations": [
+            {"op": "share", "post": self.p1.id}]},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_sqlite_production(self):
+        with tempfile.TemporaryDirectory() as directory:
+            production = sqlite3.DatabaseWrapper({
+                **connection.settings_dict,
+                "NAME": os.path.join(directory, "db.sqlite3"),
+                "OPTIONS": {
+                    "transaction_mode": "IMMEDIATE",
+                    "init_command": "PRAGMA journal_mode=WAL;"
+                        "PRAGMA synchronous=NORMAL",
+                },
+            }, alias="production")
+            statements = []
+
+            def record(execute, sql, params, many, context):
+                statements.append(sql)
+                return execute(sql, params, many, context)
+
+            try:
+                # Pragmas are applied to every connection
+                with production.cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode")
+                    self.assertEqual(cursor.fetchone()[0], "wal")
+                    cursor.execute("PRAGMA synchronous")
+                    self.assertEqual(cursor.fetchone()[0], 1)
+
+                # Transactions take the write lock when they start
+                with production.execute_wrapper(record):
+                    production.set_autocommit(False,
+                        force_begin_transaction_with_broken_autocommit=True)
+                    production.rollback()
+                self.assertEqual(statements, ["BEGIN IMMEDIATE"])
+            finally:
+                production.close()
+
+    @patch("network.models.DEFER_WORK", True)
+    def test_jobs(self):
+        # New posts reach the timelines when the worker runs
+        post = Post.objects.create(content="deferred", creator=self.user3)
+        self.assertFalse(TimelineEntry.objects.filter(post=post).exists())
+        self.assertFalse(Job.objects.enqueue("fan_out", {"post": post.id},
+            key=f"fan_out:{post.id}"))
+        Follow.objects.get(user_following=self.user2,
+            user_followed=self.user1).delete()
+        call_command("run_jobs", once=True, stdout=StringIO())
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user2,
+            post=post).exists())
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user2,
+            creator=self.user1).exists())
+        self.assertEqual(set(Job.objects.values_list("name", "status")),
+            {("fan_out", Job.DONE), ("trim", Job.DONE)})
+
+        # Jobs of the same name run together, a failing one runs alone
+        calls = []
+
+        def record(payloads):
+            calls.append(payloads)
+            if {"fail": True} in payloads:
+                raise ValueError("Failed")
+
+        with patch.dict(jobs.HANDLERS, {"record": (record, 2)}):
+            for payload in ({"n": 1}, {"fail": True}, {"n": 2}):
+                Job.objects.enqueue("record", payload)
+            out = StringIO()
+            with self.assertLogs("network.jobs", "WARNING"):
+                call_command("run_jobs", once=True, stdout=out)
+            self.assertEqual(calls, [[{"n": 1}, {"fail": True}, {"n": 2}],
+                [{"n": 1}], [{"fail": True}], [{"n": 2}]])
+            self.assertIn("record: 2 of 3 jobs", out.getvalue())
+
+            # Retried later, then given up
+            failed = Job.objects.get(name="record", status=Job.PENDING)
+            self.assertEqual(failed.attempts, 1)
+            self.assertIn("ValueError: Failed", failed.last_error)
+            self.assertGreater(failed.run_at, timezone.now())
+            Job.objects.filter(pk=failed.pk).update(run_at=timezone.now())
+            with self.assertLogs("network.jobs", "WARNING"):
+                call_command("run_jobs", once=True, stdout=StringIO())
+            failed.refresh_from_db()
+            self.assertEqual((failed.status, failed.attempts),
+                (Job.FAILED, 2))
+
+        # Batched follows reach the timeline when the worker runs
+        c = Client()
+        c.login(username="carlos", password="1234")
+        response = c.post(reverse("network:batch"), {"operations": [
+            {"op": "like", "post": self.p1.id},
+            {"op": "follow", "user": self.user1.id}]},
+            content_type="application/json")
+        self.assertEqual(response.json()["posts"][str(self.p1.id)],
+            {"likesCount": 3, "liked": True})
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user3,
+            creator=self.user1).exists())
+        call_command("run_jobs", once=True, stdout=StringIO())
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user3,
+            creator=self.user1).exists())
+
+        # Done jobs are purged after --keep-days, freeing their keys
+        call_command("run_jobs", once=True, keep_days=0, stdout=StringIO())
+        self.assertFalse(Job.objects.filter(status=Job.DONE).exists())
+
+    def test_sharding(self):
+        shards = ["test_shard0", "test_shard1"]
+        with tempfile.TemporaryDirectory() as directory:
+            for shard in shards:
+                sharding.add_database(shard, os.path.join(directory,
+                    f"{shard}.sqlite3"))
+            try:
+                with self.settings(NETWORK_SHARDS=shards,
+                        NETWORK_SHARD_MAP_TTL=0):
+                    for shard in shards:
+                        call_command("migrate", database=shard, verbosity=0)
+                    self.check_sharding()
+            finally:
+                sharding.shard_map.clear()
+                for shard in shards:
+                    sharding.remove_database(shard)
+
+    def check_sharding(self):
+        # Posts go to the shard of their creator, their id locates it
+        now = timezone.now()
+        posts = []
+        for n, user in enumerate([self.user1, self.user2, self.user3,
+                self.user1]):
+            post = Post(content=f"sharded {n}", creator=user,
+                created_at=now - timedelta(minutes=n))
+            post.save()
+            self.assertEqual(post._state.db, sharding.shard_for_user(user.id))
+            self.assertEqual(sharding.shard_for_post(post.id), post._state.db)
+            posts.append(post)
+        first = sharding.shard_for_user(self.user1.id)
+        second = sharding.shard_for_user(self.user2.id)
+        self.assertNotEqual(first, second)
+
+        c = Client()
+        c.login(username="abi", password="1234")
+        c.post(reverse("network:index"), {"content": "sharded new"})
+        self.assertTrue(Post.objects.using(second).filter(
+            content="sharded new", creator=self.user2).exists())
+        Post.objects.using(second).filter(content="sharded new").delete()
+
+        # Profiles read only the shard of the user
+        with CaptureQueriesContext(connections[second]) as queries:
+            response = c.get(reverse("network:profile",
+                args=[self.user1.id]))
+        self.assertEqual(len(queries), 0)
+        self.assertEqual([post.content for post in response.context['posts']],
+            ["sharded 0", "sharded 3"])
+
+        # Index and following merge the shards newest first
+        response = c.get(reverse("network:index"))
+        self.assertEqual([post.content for post in response.context['posts']],
+            ["sharded 0", "sharded 1", "sharded 2", "sharded 3"])
+        self.assertContains(response, "emi")
+        response = c.get(reverse("network:following"))
+        self.assertEqual([post.content for post in response.context['posts']],
+            ["sharded 0", "sharded 2", "sharded 3"])
+
+        # Likes live on the shard of their post
+        response = c.put(reverse("network:like_post", args=[posts[1].id]))
+        self.assertEqual(response.json()["likesCount"], 1)
+        self.assertTrue(Like.objects.using(second).filter(
+            post=posts[1].id).exists())
+        response = c.post(reverse("network:batch"), {"operations": [
+            {"op": "like", "post": posts[0].id},
+            {"op": "like", "post": posts[2].id}]},
+            content_type="application/json")
+        self.assertEqual(response.json()["posts"][str(posts[0].id)],
+            {"likesCount": 1, "liked": True})
+        response = c.get(reverse("network:index"))
+        self.assertEqual(response.context['liked_posts'],
+            {posts[0].id, posts[1].id, posts[2].id})
+
+        c.put(reverse("network:edit_post", args=[posts[1].id]),
+            {"content": "edited"}, content_type="application/json")
+        self.assertEqual(Post.objects.using(second).get(
+            pk=posts[1].id).content, "edited")
+
+        # Moving the bucket of a user moves its posts and their likes
+        call_command("rebalance_shards", bucket=[sharding.bucket_of_user(
+            self.user1.id)], to=second, stdout=StringIO())
+        self.assertEqual(sharding.shard_for_user(self.user1.id), second)
+        self.assertFalse(Post.objects.using(first).filter(
+            creator=self.user1).exists())
+        self.assertFalse(Like.objects.using(first).filter(
+            post=posts[0].id).exists())
+        self.assertEqual(Post.objects.using(second).get(
+            pk=posts[0].id).likes_count, 1)
+        response = c.get(reverse("network:profile", args=[self.user1.id]))
+        self.assertEqual([post.content for post in response.context['posts']],
+            ["sharded 0", "sharded 3"])
+        self.assertEqual(response.context['liked_posts'], {posts[0].id})
+
+        # Copying again brings the edits, unlikes and deletions made since
+        rebalance = RebalanceCommand()
+        rebalance.batch_size = 1
+        bucket = sharding.bucket_of_user(self.user1.id)
+        removed = Post.objects.create(content="removed", creator=self.user1)
+        rebalance.copy(bucket, second, first)
+        Post.objects.using(second).filter(pk=posts[0].id).update(
+            content="edited again")
+        Like.objects.using(second).filter(post=posts[0].id).delete()
+        Post.objects.using(second).filter(pk=removed.id).delete()
+        rebalance.copy(bucket, second, first)
+        for shard in (first, second):
+            self.assertEqual(list(rebalance.bucket_posts(shard, bucket)
+                .order_by("id").values_list("id", "content")), sorted([
+                (posts[0].id, "edited again"), (posts[3].id, "sharded 3")]))
+            self.assertFalse(Like.objects.using(shard).filter(
+                post=posts[0].id).exists())
+        rebalance.bucket_posts(first, bucket).delete()
+
+        # Imported post ids must locate the shard of their creator
+        rows = StringIO(json.dumps({"id": 1, "creator_id": self.user1.id,
+            "content": "unsharded", "created_at": now.isoformat()}))
+        with patch("sys.stdin", rows), self.assertRaisesMessage(
+                CommandError, "does not carry the bucket"):
+            call_command("import_network", "posts", "-", stdout=StringIO())
+
+        # Planned moves even out the posts of each shard
+        out = StringIO()
+        call_command("rebalance_shards", dry_run=True, stdout=out)
+        bucket = sharding.bucket_of_user(self.user2.id)
+        self.assertEqual(out.getvalue(),
+            f"Bucket {bucket}: {second} -> {first}, 1 posts\n")
+
+        # Seeded posts and likes go where the routers look for them, older
+        # posts than the id epoch included
+        call_command("seed_network", "--until=2023-01-01", users=5, posts=20,
+            follows=10, likes=30, seed=1, skip_timelines=True,
+            stdout=StringIO())
+        seeded = Post.objects.filter(content__startswith="Seeded")
+        self.assertEqual(sum(seeded.using(shard).count()
+            for shard in (first, second)), 20)
+        for shard in (first, second):
+            for post_id, creator in seeded.using(shard).values_list("id",
+                    "creator"):
+                self.assertGreaterEqual(post_id, 0)
+                self.assertEqual(sharding.shard_for_user(creator), shard)
+                self.assertEqual(sharding.shard_for_post(post_id), shard)
+
+        self.assertTrue(Like.objects.using(first).filter(
+            post__content__startswith="Seeded").exists())
+
+        # Counters drifted on any shard are rebuilt
+        Post.objects.using(first).update(likes_count=99)
+        Post.objects.using(second).update(likes_count=99)
+        call_command("reconcile_counters", batch_size=3, stdout=StringIO())
+        for shard in (first, second):
+            for post_id, likes_count in Post.objects.using(shard).values_list(
+                    "id", "likes_count"):
+                self.assertEqual(likes_count, Like.objects.using(shard).filter(
+                    post=post_id).count())
+
+    def test_replica_router(self):
+        router = routers.ReplicaRouter()
+        factory = RequestFactory()
+
+        def view(request):
+            if request.GET.get("write"):
+                Post.objects.filter(pk=self.p1.pk).update(content="abc")
+            return HttpResponse(router.db_for_read(Post))
+
+        # Outside the transaction of the test, as in a request
+        token = routers.pinned_to_primary.set(None)
+        try:
+            with self.settings(NETWORK_DB_REPLICAS=["replica1"]), \
+                    patch.object(connection, "in_atomic_block", False):
+                middleware = ReplicaPinningMiddleware(view)
+                # Reads go to the replicas
+                response = middleware(factory.get("/"))
+                self.assertEqual(response.content, b"replica1")
+                self.assertNotIn("network_primary", response.cookies)
+
+                # Reads after a write go to the primary, and so do those of
+                # the next requests
+                response = middleware(factory.post("/"))
+                self.assertEqual(response.content, b"default")
+                self.assertEqual(
+                    response.cookies["network_primary"]["max-age"], 5)
+                response = middleware(factory.get("/", {"write": 1}))
+                self.assertEqual(response.content, b"default")
+                self.assertIn("network_primary", response.cookies)
+
+                request = factory.get("/")
+                request.COOKIES["network_primary"] = "1"
+                response = middleware(request)
+                self.assertEqual(response.content, b"default")
+                self.assertNotIn("network_primary", response.cookies)
+
+                # The request context is restored afterwards, and writes
+                # outside requests pin nothing
+                self.assertEqual(router.db_for_read(Post), "replica1")
+                self.assertEqual(router.db_for_write(Post), "default")
+                Post.objects.filter(pk=self.p1.pk).update(content="abc")
+                self.assertEqual(router.db_for_read(Post), "replica1")
+        finally:
+            routers.pinned_to_primary.reset(token)
+
+        # Writes go to the primary even when the reads would not
+        with patch.object(routers.ReplicaRouter, "db_for_read",
+                return_value="replica1"):
+            Like.objects.like(self.user3.id, self.p1.id)
+        self.assertTrue(Like.objects.filter(user=self.user3,
+            post=self.p1).exists())
+
+    @skipUnless(connection.vendor == "postgresql", "Needs DATABASE_URL")
+    def test_postgresql_settings(self):
+        # Statements are cancelled after NETWORK_DB_STATEMENT_TIMEOUT
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT setting FROM pg_settings WHERE name = "
+                "'statement_timeout'")
+            timeout = cursor.fetchone()[0]
+        self.assertEqual(timeout, str(os.environ.get(
+            "NETWORK_DB_STATEMENT_TIMEOUT", 5000)))
+        self.assertTrue(connection.settings_dict["CONN_HEALTH_CHECKS"])
+
+    def test_database_from_url(self):
+        from project4.settings import BASE_DIR, database_from_url
+        self.assertEqual(database_from_url("sqlite:///db.sqlite3")["NAME"],
+            os.path.join(BASE_DIR, "db.sqlite3"))
+        self.assertEqual(
+            database_from_url("sqlite:////var/db.sqlite3")["NAME"],
+            "/var/db.sqlite3")
+        with patch.dict(os.environ, {"NETWORK_DB_CONN_MAX_AGE": "0"}):
+            database = database_from_url("postgres://u:p@db:5432/network")
+        self.assertEqual(database["CONN_MAX_AGE"], 0)
+        self.assertEqual(database["NAME"], "network")
+
+    def test_export_import(self):
+        posts = list(Post.objects.order_by("id").values_list("id", "creator",
+            "content", "created_at", "likes_count"))
+        likes = set(Like.objects.values_list("user", "post"))
+        with tempfile.TemporaryDirectory() as directory:
+            for table, format in (("posts", "csv"), ("likes", "jsonl"),
+                    ("follows", "jsonl")):
+                path = os.path.join(directory, f"{table}.{format}")
+                err = StringIO()
+                call_command("export_network", table, output=path,
+                    chunk_size=2, stderr=err)
+                self.assertIn("Exported", err.getvalue())
+                self.assertIn("rows/s", err.getvalue())
+
+            # Loaded back into empty tables, counters and timelines rebuilt
+            Like.objects.all().delete()
+            Follow.objects.all().delete()
+            Post.objects.all().delete()
+            User.objects.update(followers_count=0, following_count=0)
+            out = StringIO()
+            for table, format in (("posts", "csv"), ("follows", "jsonl"),
+                    ("likes", "jsonl")):
+                path = os.path.join(directory, f"{table}.{format}")
+                call_command("import_network", table, path, batch_size=2,
+                    stdout=out)
+            self.assertIn("Imported posts: 3 rows sent", out.getvalue())
+
+            # Only the counters of the imported rows are counted again
+            Post.objects.filter(pk=self.p2.pk).update(likes_count=5)
+            call_command("import_network", "likes", path, stdout=StringIO())
+            self.assertEqual(Post.objects.get(pk=self.p2.pk).likes_count, 5)
+            Post.objects.filter(pk=self.p2.pk).update(likes_count=0)
+        self.assertEqual(list(Post.objects.order_by("id").values_list("id",
+            "creator", "content", "created_at", "likes_count")), posts)
+        self.assertEqual(set(Like.objects.values_list("user", "post")), likes)
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user2.following_count, 2)
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user2,
+            post=self.p3).exists())
+        # Ids go on after the imported ones
+        self.assertGreater(Post.objects.create(content="next",
+            creator=self.user3).id, self.p3.id)
+
+        # Conflicting rows are skipped, or updated for posts
+        rows = StringIO(json.dumps({"id": self.p1.id, "creator_id":
+            self.user1.id, "content": "new", "created_at":
+            self.p1.created_at.isoformat()}) + "\n")
+        with patch("sys.stdin", rows):
+            call_command("import_network", "posts", "-", stdout=StringIO())
+        self.assertEqual(Post.objects.get(pk=self.p1.pk).content, "abc")
+        self.assertContains(Client().get("/"), "abc")
+        rows.seek(0)
+        with patch("sys.stdin", rows):
+            call_command("import_network", "posts", "-", on_conflict="update",
+                stdout=StringIO())
+        self.assertEqual(Post.objects.get(pk=self.p1.pk).content, "new")
+        # Cached cards of the old content are left
+        self.assertContains(Client().get("/"), "new")
+
+        # Rows of missing users and self-follows are skipped
+        rows = StringIO("\n".join(json.dumps(row) for row in [
+            {"id": 100, "creator_id": 99, "content": "orphan",
+                "created_at": self.p1.created_at.isoformat()},
+            {"id": 101, "creator_id": self.user1.id, "content": "kept",
+                "created_at": self.p1.created_at.isoformat()}]))
+        out = StringIO()
+        with patch("sys.stdin", rows):
+            call_command("import_network", "posts", "-", stdout=out)
+        self.assertIn("Skipped 1 rows", out.getvalue())
+        self.assertEqual(list(Post.objects.filter(pk__in=[100, 101])
+            .values_list("content", flat=True)), ["kept"])
+        rows = StringIO("\n".join([json.dumps({"user_id": 99,
+            "post_id": self.p1.id})]))
+        with patch("sys.stdin", rows):
+            call_command("import_network", "likes", "-", stdout=StringIO())
+        self.assertFalse(Like.objects.filter(user=99).exists())
+        rows = StringIO(json.dumps({"user_following_id": self.user1.id,
+            "user_followed_id": self.user1.id}))
+        with patch("sys.stdin", rows):
+            call_command("import_network", "follows", "-", stdout=StringIO())
+        self.assertFalse(Follow.objects.filter(user_following=self.user1,
+            user_followed=self.user1).exists())
+
+        # Standard output holds nothing but the rows
+        out = StringIO()
+        call_command("export_network", "follows", format="csv", stdout=out,
+            stderr=StringIO())
+        self.assertEqual(out.getvalue().splitlines()[0],
+            "user_following_id,user_followed_id")
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+    def test_export_user_data(self):
+        url = reverse("network:export")
+        c = Client()
+        self.assertEqual(c.get(url).status_code, 302)
+        c.force_login(self.user2)
+
+        # Every table as JSON lines, streamed
+        response = c.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response.headers["Content-Type"],
+            "application/x-ndjson")
+        rows = [json.loads(line) for line in
+            b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["type"] for row in rows], ["posts", "likes",
+            "likes", "following", "following"])
+        self.assertEqual(rows[0]["id"], self.p2.id)
+        self.assertEqual(rows[0]["content"], "def")
+        self.assertEqual({row["post_id"] for row in rows[1:3]},
+            {self.p1.id, self.p3.id})
+        self.assertEqual(rows[3], {"type": "following",
+            "user_id": self.user3.id, "username": "carlos"})
+
+        # One table as CSV, read a chunk at a time
+        with patch("network.transfer.EXPORT_CHUNK_SIZE", 1):
+            response = c.get(url, {"format": "csv", "table": "following"})
+            chunks = list(response.streaming_content)
+        self.assertEqual(chunks, [b"user_id,username\r\n",
+            b"%d,carlos\r\n" % self.user3.id, b"%d,emi\r\n" % self.user1.id])
+        self.assertIn('filename="abi-following.csv"',
+            response.headers["Content-Disposition"])
+        self.assertEqual(c.get(url, {"format": "csv"}).status_code, 400)
+        self.assertEqual(c.get(url, {"format": "xml"}).status_code, 400)
+        self.assertEqual(c.get(url, {"table": "users"}).status_code, 400)
+
+    async def test_export_user_data_async(self):
+        c = AsyncClient()
+        await c.aforce_login(self.user1)
+        with self.settings(ROOT_URLCONF="project4.async_urls"):
+            response = await c.get(reverse("network:export"),
+                {"table": "followers"})
+            lines = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(json.loads(b"".join(lines)), {"type": "followers",
+            "user_id": self.user2.id, "username": "abi"})
+
+    def test_cursor_pagination_fallback(self):
+        c = Client()
+        # Invalid cursors show the first page
+        response = c.get("/", {"cursor": "not-a-cursor"})
+        self.assertEqual(len(response.context['posts']), 3)
+        self.assertFalse(response.context['posts'].has_previous())
+
+        # Shallow page numbers keep using the regular paginator
+        response = c.get("/profile/1", {"page": 1})
+        self.assertEqual(response.context['posts'].number, 1)
+        self.assertEqual(len(response.context['posts']), 2)
+
+        # Merged feeds only have a first page by number
+        c.force_login(self.user2)
+        response = c.get(reverse("network:following"), {"page": 1})
+        self.assertEqual(len(response.context['posts']), 2)
+        response = c.get(reverse("network:following"), {"page": 2})
+        self.assertEqual(response.status_code, 404)
+
+    @patch("network.pagination.MAX_PAGE_NUMBER", 2)
+    def test_page_number_limit(self):
+        for i in range(37):
+            Post.objects.create(content=f"{i}", creator=self.user1)
+        c = Client()
+        # The deepest page links to cursors, the rest of the feed follows
+        response = c.get("/", {"page": 1})
+        self.assertContains(response, "?page=2")
+        last_cursor = response.context['posts'].last_cursor
+        self.assertContains(response, f"?cursor={last_cursor}")
+        response = c.get("/", {"page": 2})
+        posts = response.context['posts']
+        self.assertNotContains(response, "?page=3")
+        self.assertContains(response, f"?cursor={posts.next_cursor}")
+        response = c.get("/", {"cursor": posts.next_cursor})
+        self.assertEqual(response.context['posts'][0].content, "16")
+
+        # Deeper page numbers do not restart the feed
+        self.assertEqual(c.get("/", {"page": 3}).status_code, 404)
 
 
 class NetworkFrontTestCase(CommonSetUp, StaticLiveServerTestCase):
@@ -162,6 +1322,11 @@ class NetworkFrontTestCase(CommonSetUp, StaticLiveServerTestCase):
         cls.driver.quit()
         super().tearDownClass()
 
+    def wait_for_text(self, element, text):
+        """Wait for clicks queued by index.js to be sent and answered"""
+        WebDriverWait(self.driver, 5).until(lambda driver:
+            element.text == text)
+
     def setUp(self):
         """Add login setUp"""
         super().setUp()
@@ -233,10 +1398,11 @@ class NetworkFrontTestCase(CommonSetUp, StaticLiveServerTestCase):
             self.assertEqual(like_text.text, original_like_tag[i])
             self.assertEqual(like_count.text, original_count[i])
             
-            # Like the post and test again
+            # Like the post and test again once the batch is sent
             like_img.click()
             like_count = likes[i].find_elements(By.XPATH, './/span')[0]
             self.assertEqual(like_text.text, new_like_tag[i])
+            self.wait_for_text(like_count, new_count[i])
             self.assertEqual(like_count.text, new_count[i])
 
     def test_index_paginator_next(self):
@@ -289,9 +1455,9 @@ class NetworkFrontTestCase(CommonSetUp, StaticLiveServerTestCase):
         self.assertEqual(followers.text, "0")
         self.assertEqual(following.text, "2")
 
-        # Follow and check follow numbers
+        # Follow and check follow numbers once the batch is sent
         button_follow.click()
-        self.driver.implicitly_wait(5)
+        self.wait_for_text(followers, "1")
 
         # Unfollow and check follow numbers    
         self.assertEqual(button_follow.text, "Unfollow")
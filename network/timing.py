@@ -0,0 +1,102 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+
+# Timing of the request being served, None when nobody is measuring
+current_timing = ContextVar("current_timing", default=None)
+
+# Objects told about every query of the request being served
+query_observers = ContextVar("query_observers", default=())
+
+
+def observe_queries(execute, sql, params, many, context):
+    """Database execute wrapper timing statements for the query observers"""
+    observers = query_observers.get()
+    if not observers:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        for observer in observers:
+            observer.observe(elapsed, sql)
+
+
+def install_query_observer(sender=None, connection=None, **kwargs):
+    """
+    Wrap the queries of a connection, receiving connection_created. Under
+    ASGI the ORM runs in other threads than the middleware, with their own
+    connections, the observers follow the request through its context.
+    """
+    connections_ = [connection] if connection else connections.all(
+        initialized_only=True)
+    for connection in connections_:
+        if observe_queries not in connection.execute_wrappers:
+            connection.execute_wrappers.append(observe_queries)
+
+
+@contextmanager
+def observing_queries(observer):
+    """Tell observer about the queries made in this context"""
+    token = query_observers.set(query_observers.get() + (observer,))
+    try:
+        yield observer
+    finally:
+        query_observers.reset(token)
+
+
+class RequestTiming:
+    """Time spent by one request in the database and rendering templates"""
+    def __init__(self, slow_query_seconds=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        # Templates being rendered, only the outermost one is timed
+        self.rendering = 0
+        self.slow_queries = []
+
+    def observe(self, elapsed, sql):
+        """Count and time a statement"""
+        self.queries += 1
+        self.db_time += elapsed
+        if self.slow_query_seconds is not None and \
+                elapsed >= self.slow_query_seconds:
+            self.slow_queries.append((elapsed, sql))
+
+
+class TimedTemplate:
+    """Template wrapper adding its render time to the current request"""
+    def __init__(self, template):
+        self.template = template
+
+    @property
+    def origin(self):
+        return self.template.origin
+
+    def render(self, context=None, request=None):
+        timing = current_timing.get()
+        # Nested renders, such as cards, are part of the outer one
+        if timing is None or timing.rendering:
+            return self.template.render(context, request)
+        timing.rendering += 1
+        started = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            timing.template_time += time.perf_counter() - started
+            timing.rendering -= 1
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Django templates backend that reports render time to RequestTiming"""
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
@@ -0,0 +1,143 @@
+import csv
+import json
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from . import sharding
+from .feeds import user_posts
+from .models import Post, Follow, Like
+
+
+# Model and columns of every table moved by export_network and
+# import_network, likes_count and the follow counters are rebuilt
+TABLES = {
+    "posts": (Post, ("id", "creator_id", "content", "created_at")),
+    "likes": (Like, ("user_id", "post_id")),
+    "follows": (Follow, ("user_following_id", "user_followed_id")),
+}
+FORMATS = ("jsonl", "csv")
+
+# Rows fetched at a time, and lines sent at a time, by the user data export
+EXPORT_CHUNK_SIZE = getattr(settings, "NETWORK_EXPORT_CHUNK_SIZE", 2000)
+
+
+def guess_format(path, format):
+    """The given format, else the one of the file extension, else JSONL"""
+    if format:
+        return format
+    if path and path.endswith(".csv"):
+        return "csv"
+    return "jsonl"
+
+
+def databases(model):
+    """Databases holding the rows of a model, every shard for posts and likes"""
+    if model in (Post, Like) and sharding.shards():
+        return sharding.shards()
+    return [None]
+
+
+def plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class Line:
+    """File-like object handing back what csv.writer writes to it"""
+    def write(self, value):
+        return value
+
+
+def format_rows(format, columns, rows):
+    """Lines of value tuples as JSON lines or CSV with a header"""
+    if format == "csv":
+        writer = csv.writer(Line())
+        yield writer.writerow(columns)
+        for row in rows:
+            yield writer.writerow(map(plain, row))
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(columns, map(plain, row))),
+                ensure_ascii=False) + "\n"
+
+
+def write_rows(stream, format, columns, rows):
+    """Write value tuples as JSON lines or CSV with a header"""
+    for line in format_rows(format, columns, rows):
+        stream.write(line)
+
+
+def read_rows(stream, format, model, columns):
+    """
+    Field values of every JSON line or CSV row, converted to Python types.
+    Raises ValueError on a malformed row.
+    """
+    fields = [model._meta.get_field(column) for column in columns]
+    records = csv.DictReader(stream) if format == "csv" else (
+        json.loads(line) for line in stream if line.strip())
+    for number, record in enumerate(records, 1):
+        try:
+            yield {column: field.to_python(record[column])
+                for column, field in zip(columns, fields)}
+        except (KeyError, ValidationError) as error:
+            raise ValueError(f"Row {number}: {error}")
+
+
+def user_tables(user):
+    """Columns and querysets of the rows of every table of a user's data"""
+    return {
+        "posts": (("id", "content", "created_at", "likes_count"), [
+            user_posts(user.id).order_by("id").values_list("id", "content",
+            "created_at", "likes_count")]),
+        # Likes are stored on the shards of their posts
+        "likes": (("post_id",), [
+            Like.objects.using(db).filter(user=user).order_by("post")
+            .values_list("post") for db in databases(Like)]),
+        "following": (("user_id", "username"), [
+            Follow.objects.filter(user_following=user).order_by("id")
+            .values_list("user_followed", "user_followed__username")]),
+        "followers": (("user_id", "username"), [
+            Follow.objects.filter(user_followed=user).order_by("id")
+            .values_list("user_following", "user_following__username")]),
+    }
+
+
+def export_user(user, format, names):
+    """
+    Lines of the named tables of a user's data, JSON lines with the table
+    name as type or CSV. Rows are read EXPORT_CHUNK_SIZE at a time, through
+    a server-side cursor where the database has them.
+    """
+    tables = user_tables(user)
+    for name in names:
+        columns, querysets = tables[name]
+        rows = (row for queryset in querysets
+            for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+        if format == "csv":
+            yield from format_rows(format, columns, rows)
+        else:
+            yield from format_rows(format, ("type",) + columns,
+                ((name,) + row for row in rows))
+
+
+def joined(lines):
+    """Lines joined EXPORT_CHUNK_SIZE at a time, for fewer and larger writes"""
+    lines = iter(lines)
+    while chunk := "".join(islice(lines, EXPORT_CHUNK_SIZE)):
+        yield chunk
+
+
+async def aiterate(chunks):
+    """
+    Iterate a blocking generator from the event loop. Each chunk is made in
+    the thread holding the database connection, keeping its cursor open.
+    """
+    produce = sync_to_async(next)
+    try:
+        while (chunk := await produce(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
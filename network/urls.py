@@ -22,4 +22,10 @@ urlpatterns = [
 
     #API Routes
     path("follow", views.follow, name="follow"),
+    path("batch", views.batch, name="batch"),
+    path("api/posts", views.api_posts, name="api_posts"),
+    path("events", views.events, name="events"),
+    path("export", views.export, name="export"),
+    # Monitoring
+    path("metrics", views.metrics, name="metrics"),
 ]
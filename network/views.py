@@ -1,39 +1,28 @@
 import json
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
 from django.db import IntegrityError
-from django.db.models import Count
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
-from django.shortcuts import render
+from django.db.models import BooleanField, Exists, OuterRef, Value
+from django.http import (HttpResponse, HttpResponseRedirect, JsonResponse,
+    StreamingHttpResponse)
+from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
-from .models import User, Post, Follow, Like
+from .models import User, Post, Follow, Like, TimelineEntry
+from . import metrics as network_metrics, sharding
+from .batch import apply_operations
+from .conditional import page_etag, render_page
+from .events import event_stream, publish_on_commit, served_by_asgi
+from .feeds import (all_posts, feed_sources, get_feed, serialize_post,
+    user_posts)
 from .forms import PostForm
-
-
-def paginate_posts(request, posts):
-    """Function to paginate posts"""
-    # Paginate
-    paginator = Paginator(posts, 10)
-    page_number = request.GET.get('page')
-    posts = paginator.get_page(page_number)
-    return posts
-
-def get_liked_posts(request):
-    if request.user.is_authenticated:
-        return Like.objects.filter(user=request.user).values_list("post",
-            flat=True)
-    else: 
-        return 
+from .transfer import export_user, joined, user_tables
 
 def index(request):
     """Main page, it shows all the posts and it let create a new one"""
-    posts = Post.objects.all().order_by("-created_at")
-    posts = paginate_posts(request, posts)
-    liked_posts = get_liked_posts(request)
-    
     # If a post is submited
     if request.method == "POST":
         form = PostForm(request.POST)
@@ -41,56 +30,68 @@ def index(request):
             new_post = Post(content=form.cleaned_data['content'],
                 creator=request.user)
             new_post.save()
+            network_metrics.posts_created.inc()
+            publish_on_commit("post", {"id": new_post.id,
+                "creator": request.user.id})
             return HttpResponseRedirect(reverse("network:index"))  
     
     # Regular load
     else:  
         form = PostForm()
 
-    return render(request, "network/index.html", {
+    posts = all_posts()
+    posts = get_feed(request, posts)
+
+    return render_page(request, "network/index.html", {
+        "feed": "all",
+        "live_events": served_by_asgi(request),
         "form": form,
         "posts": posts,
-        "liked_posts": liked_posts,
-    })
+        "liked_posts": posts.liked_posts,
+    }, page_etag(request, posts))
 
 
 def profile(request, user_id):
     """Show profile of a selected user"""
-    profile_user = User.objects.get(pk=user_id)
-    
-    # Determine if request user is following profile user or no
-    if profile_user.followers_list.filter(user_following=request.user.id).exists():
-        profile_user.is_following = True
+    # Header with stored counters and whether request user is following
+    if request.user.is_authenticated:
+        is_following = Exists(Follow.objects.filter(user_followed=OuterRef(
+            "pk"), user_following=request.user))
     else:
-        profile_user.is_following = False
-    
-    posts = Post.objects.filter(creator=user_id).order_by("-created_at")
-    posts = paginate_posts(request, posts)
-    liked_posts = get_liked_posts(request)
+        is_following = Value(False, output_field=BooleanField())
+    profile_user = get_object_or_404(User.objects.only("id", "username",
+        "followers_count", "following_count").annotate(
+        is_following=is_following), pk=user_id)
+
+    posts = user_posts(user_id)
+    posts = get_feed(request, posts)
 
-    return render(request, "network/profile.html", {
+    # The header changes with follows made by anyone
+    etag = page_etag(request, posts, profile_user.id,
+        profile_user.followers_count, profile_user.following_count,
+        profile_user.is_following)
+    return render_page(request, "network/profile.html", {
+        "feed": f"user:{profile_user.id}",
+        "live_events": served_by_asgi(request),
         "profile_user": profile_user,
         "posts": posts,
-        "liked_posts": liked_posts,
-    })
+        "liked_posts": posts.liked_posts,
+    }, etag)
 
 
 @login_required
 def following(request):
     """Show posts from following users"""
-    # Get user's following list
-    following_list = Follow.objects.filter(
-        user_following=request.user.id).values_list("user_followed")
-    # Get posts filtered by user's following list
-    posts = Post.objects.filter(
-        creator__in=following_list).order_by("-created_at")
-    posts = paginate_posts(request, posts)
-    liked_posts = get_liked_posts(request)
-
-    return render(request, "network/following.html", {
+    # Read the user's timeline, merged with high follower accounts posts
+    posts = TimelineEntry.objects.feed_sources(request.user)
+    posts = get_feed(request, posts)
+
+    return render_page(request, "network/following.html", {
+        "feed": "following",
+        "live_events": served_by_asgi(request),
         "posts": posts,
-        "liked_posts": liked_posts,
-    })
+        "liked_posts": posts.liked_posts,
+    }, page_etag(request, posts))
 
 
 @login_required
@@ -112,8 +113,11 @@ def follow(request):
                 user_followed=user_to_follow)
             unfollow.delete()
             message = "Unfollowing"
+        network_metrics.follows_changed.inc(action=message.lower())
+        user_to_follow.refresh_from_db(fields=["followers_count"])
         result = {
             "message": message,
+            "followersCount": user_to_follow.followers_count,
         }
         return JsonResponse(result)
     else:
@@ -124,10 +128,12 @@ def follow(request):
 def edit_post(request, post_id):
     """Modify the content of a post"""
     if request.method == "PUT":
-        post = Post.objects.get(pk=post_id)
+        post = Post.objects.using(sharding.shard_for_post(post_id)).get(
+            pk=post_id)
         data = json.loads(request.body)
         post.content = data['content']
-        post.save()
+        # Leave the likes counter to concurrent likes
+        post.save(update_fields=["content"])
         return JsonResponse({"message": "Post modified succesfully"})
     else:
         return JsonResponse({"message": "Method should be PUT"})
@@ -135,27 +141,175 @@ def edit_post(request, post_id):
 
 @login_required
 def like_post(request, post_id):
-    """Like or unlike a post"""
+    """
+    Like (PUT) or unlike (DELETE) a post, retries change nothing. POST
+    toggles the like.
+    """
+    if request.method == "PUT":
+        result, liked = Like.objects.like(request.user.id, post_id), True
+    elif request.method == "DELETE":
+        result, liked = Like.objects.unlike(request.user.id, post_id), False
+    elif request.method == "POST":
+        result = Like.objects.toggle(request.user.id, post_id)
+    else:
+        return JsonResponse({"message": "You should use request method POST"})
+    if result is None:
+        return JsonResponse({"message": "Post not found"}, status=404)
+
+    likes_count, changed = result
+    # A toggle tells whether the post ended up liked, it always changes
     if request.method == "POST":
-        post = Post.objects.get(pk=post_id)
-        # Like a coment
-        try:
-            like = Like(user=request.user, post=post)
-            like.save()
-            message = "liked"
-        except IntegrityError:
-            like = Like.objects.get(user= request.user, post=post)
-            like.delete()
-            message = "unliked"
+        liked, changed = changed, True
+    message = "liked" if liked else "unliked"
+    if changed:
+        network_metrics.likes_toggled.inc(action=message)
+        publish_on_commit("like", {"id": post_id, "likesCount": likes_count})
+    return JsonResponse({
+        "message": message,
+        "likesCount": likes_count,
+        })
 
-        likes_count = Like.objects.filter(post=post).aggregate(
-            Count("id"))["id__count"]
-        return JsonResponse({
-            "message": message,
-            "likesCount": likes_count,
-            }) 
+
+@login_required
+def batch(request):
+    """
+    Apply queued like, unlike, follow and unfollow operations at once,
+    {"operations": [{"op": "like", "post": <id>}, {"op": "follow",
+    "user": <id>}, ...]}, and return the counts of every target
+    """
+    if request.method != "POST":
+        return JsonResponse({"message": "Method should be POST"})
+    try:
+        operations = json.loads(request.body)["operations"]
+        posts, users, changed_posts, changed_users = apply_operations(
+            request.user, operations)
+    except (ValueError, KeyError, TypeError) as error:
+        return JsonResponse({"message": str(error)}, status=400)
+
+    for post_id in changed_posts:
+        post = posts[post_id]
+        network_metrics.likes_toggled.inc(
+            action="liked" if post["liked"] else "unliked")
+        publish_on_commit("like", {"id": post_id,
+            "likesCount": post["likesCount"]})
+    for user_id in changed_users:
+        network_metrics.follows_changed.inc(
+            action="following" if users[user_id]["following"] else
+            "unfollowing")
+    return JsonResponse({"posts": posts, "users": users})
+
+
+def api_posts(request):
+    """Page of a feed in JSON, ?feed=all|following|user:<id>&cursor="""
+    feed = request.GET.get("feed", "all")
+    if feed == "following" and not request.user.is_authenticated:
+        return JsonResponse({"message": "Log in to read the following feed"},
+            status=401)
+    try:
+        posts = feed_sources(feed, request.user)
+    except ValueError:
+        return JsonResponse({"message": "Feed should be all, following or "
+            "user:<id>"}, status=400)
+    posts = get_feed(request, posts)
+
+    return JsonResponse({
+        "posts": [serialize_post(post, request.user) for post in posts],
+        "nextCursor": posts.next_cursor,
+    })
+
+
+# Formats of the data export, as written by transfer and sent
+EXPORT_FORMATS = {
+    "ndjson": ("jsonl", "application/x-ndjson"),
+    "csv": ("csv", "text/csv; charset=utf-8"),
+}
+
+
+def export_response(request, user, stream=iter):
+    """
+    Data of a user streamed as ?format=ndjson|csv, every table or
+    ?table=posts|likes|following|followers, one table for CSV
+    """
+    format = request.GET.get("format", "ndjson")
+    table = request.GET.get("table")
+    tables = list(user_tables(user))
+    if format not in EXPORT_FORMATS:
+        return JsonResponse({"message": "Format should be ndjson or csv"},
+            status=400)
+    if table is not None and table not in tables or (format == "csv" and
+            table is None):
+        return JsonResponse({"message": "Table should be one of "
+            f"{', '.join(tables)}"}, status=400)
+
+    # Rows are read as the client takes them, never held all at once
+    lines = export_user(user, EXPORT_FORMATS[format][0],
+        [table] if table else tables)
+    filename = f"{user.username}-{table or 'network'}.{format}"
+    return StreamingHttpResponse(stream(joined(lines)),
+        content_type=EXPORT_FORMATS[format][1],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "private, no-store"})
+
+
+@login_required
+def export(request):
+    """Download the posts, likes and follow lists of the user"""
+    return export_response(request, request.user)
+
+
+async def events(request):
+    """
+    Server-Sent Events of a feed page, served under ASGI: like counts of
+    ?posts=<id>,<id> and the new posts of ?feed=all|following|user:<id>
+    """
+    # 204 tells the browser not to reconnect, WSGI would hold the worker
+    # for the whole stream and send it at the end
+    if not served_by_asgi(request):
+        return HttpResponse(status=204)
+    try:
+        post_ids = {int(post_id) for post_id in
+            request.GET.get("posts", "").split(",") if post_id}
+    except ValueError:
+        return JsonResponse({"message": "Posts should be a list of ids"},
+            status=400)
+    max_posts = getattr(settings, "NETWORK_EVENTS_MAX_POSTS", 50)
+    if len(post_ids) > max_posts:
+        return JsonResponse({"message": f"Follow up to {max_posts} posts, "
+            "those on screen"}, status=400)
+
+    # Creators whose new posts are announced, None for everyone
+    feed = request.GET.get("feed", "all")
+    user = await request.auser()
+    if feed == "all":
+        creators = None
+    elif feed == "following" and user.is_authenticated:
+        creators = {user_id async for user_id in Follow.objects.filter(
+            user_following=user).values_list("user_followed", flat=True)}
+    elif feed == "following":
+        return JsonResponse({"message": "Log in to follow the following "
+            "feed"}, status=401)
+    elif feed.startswith("user:") and feed[len("user:"):].isdigit():
+        creators = {int(feed[len("user:"):])}
     else:
-        return JsonResponse({"message": "You should use request method POST"})
+        return JsonResponse({"message": "Feed should be all, following or "
+            "user:<id>"}, status=400)
+
+    return StreamingHttpResponse(event_stream(post_ids, creators),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def metrics(request):
+    """
+    Metrics of every worker in Prometheus text format, for staff users or
+    scrapers sending the NETWORK_METRICS_TOKEN bearer token
+    """
+    token = getattr(settings, "NETWORK_METRICS_TOKEN", None)
+    if not request.user.is_staff and not (token and constant_time_compare(
+            request.headers.get("Authorization", ""), f"Bearer {token}")):
+        return HttpResponse(status=403)
+    return HttpResponse(network_metrics.registry.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 def login_view(request):
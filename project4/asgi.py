@@ -2,6 +2,10 @@
 ASGI config for project4 project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Live updates on /events need it, e.g. ``uvicorn project4.asgi:application``,
+and it serves the JSON endpoints with async views unless NETWORK_ASYNC_VIEWS=0.
+Database connections are closed after each request unless
+NETWORK_DB_CONN_MAX_AGE says otherwise, each one runs in its own thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -12,5 +16,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project4.settings')
+os.environ.setdefault('NETWORK_ASYNC_VIEWS', '1')
+os.environ.setdefault('NETWORK_DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
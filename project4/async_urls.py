@@ -0,0 +1,12 @@
+"""project4 URL Configuration of the ASGI deployment
+
+Same routes as project4.urls, with the JSON endpoints of the network app
+served by async views. Used when NETWORK_ASYNC_VIEWS is set.
+"""
+from django.contrib import admin
+from django.urls import include, path
+
+urlpatterns = [
+    path("admin/", admin.site.urls),
+    path("", include("network.async_urls")),
+]